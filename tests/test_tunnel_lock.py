@@ -0,0 +1,117 @@
+import os
+import sys
+import signal
+import socket
+import subprocess
+import textwrap
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tunnel_master')
+LAUNCHES = 50
+
+# stands in for autossh: records the spawn, then a detached child answers
+# with an ssh banner on the forwarded port like a live main tunnel would
+AUTOSSH_STUB = textwrap.dedent('''\
+    #!%(python)s
+    import os, sys, time, socket
+    args = sys.argv[1:]
+    with open(%(spawns)r, 'a') as f_obj:
+        f_obj.write(' '.join(args) + '\\n')
+    port = int(args[args.index('-L') + 1].split(':')[0])
+    if os.fork():
+        sys.exit(0)
+    os.setsid()
+    with open(%(listeners)r, 'a') as f_obj:
+        f_obj.write('%%s\\n' %% os.getpid())
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(128)
+    sock.settimeout(0.5)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn, _ = sock.accept()
+        except socket.timeout:
+            continue
+        conn.sendall(b'SSH-2.0-stub\\r\\n')
+        conn.close()
+''')
+
+# stands in for pgrep -f: a pattern matches once a recorded spawn contains it
+PGREP_STUB = textwrap.dedent('''\
+    #!%(python)s
+    import sys
+    pattern = sys.argv[-1]
+    try:
+        with open(%(spawns)r) as f_obj:
+            lines = [line for line in f_obj if pattern in line]
+    except IOError:
+        lines = []
+    sys.stdout.write(''.join(lines))
+    sys.exit(0 if lines else 1)
+''')
+
+LAUNCH_SCRIPT = textwrap.dedent('''\
+    import sys
+    sys.path.insert(0, %(package_dir)r)
+    from bastion import ensure_main_tunnel
+    created = ensure_main_tunnel('stress', 'stress.example', %(port)s, ['u@127.0.0.1:1'], {})
+    sys.exit(0 if created else 1)
+''')
+
+
+def _write_stub(path, template, spawns, listeners):
+    with open(path, 'w') as f_obj:
+        f_obj.write(template % {'python': sys.executable, 'spawns': spawns, 'listeners': listeners})
+    os.chmod(path, 0o755)
+
+
+def _kill_listeners(listeners):
+    # the stub listeners are detached, they would otherwise outlive the test
+    try:
+        with open(listeners) as f_obj:
+            pids = [int(pid) for pid in f_obj.read().split()]
+    except IOError:
+        return
+
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_concurrent_launches_spawn_one_main_tunnel(tmp_path):
+    stub_dir = tmp_path / 'bin'
+    home_dir = tmp_path / 'home'
+    stub_dir.mkdir()
+    (home_dir / '.local' / 'share').mkdir(parents=True)
+    spawns = str(tmp_path / 'spawns')
+    listeners = str(tmp_path / 'listeners')
+
+    _write_stub(str(stub_dir / 'autossh'), AUTOSSH_STUB, spawns, listeners)
+    _write_stub(str(stub_dir / 'pgrep'), PGREP_STUB, spawns, listeners)
+
+    env = dict(os.environ, HOME=str(home_dir), PATH='%s:%s' % (stub_dir, os.environ['PATH']))
+    script = LAUNCH_SCRIPT % {'package_dir': PACKAGE_DIR, 'port': _free_port()}
+
+    # the first import creates the app directories, keep that out of the race
+    subprocess.check_call([sys.executable, '-c', 'import sys; sys.path.insert(0, %r); import config' % PACKAGE_DIR], env=env)
+
+    try:
+        launches = [subprocess.Popen([sys.executable, '-c', script], env=env) for _ in range(LAUNCHES)]
+        statuses = [proc.wait(timeout=120) for proc in launches]
+
+        with open(spawns) as f_obj:
+            spawned = f_obj.read().splitlines()
+    finally:
+        _kill_listeners(listeners)
+
+    assert statuses == [0] * LAUNCHES
+    assert len(spawned) == 1
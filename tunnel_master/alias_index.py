@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import pickle
+import heapq
+import bisect
+import logging
+import collections
+import subprocess
+from array import array
+
+from config import HOSTS_FILENAME, ALIAS_INDEX_FILENAME
+
+log = logging.getLogger('stm')
+
+FUZZY_THRESHOLD = 0.6
+MAX_FUZZY_RESULTS = 200
+ENTRY_FIELDS = (
+    'alias', 'kind', 'user', 'host', 'port', 'host_alias', 'parent_port', 'service_type', 'forward_mode',
+)
+INDEX_FIELDS = ('alias', 'user', 'host', 'host_alias', 'service_type',)
+L_FORWARD_RX = re.compile(r'-L (\d+):')
+FORWARDER_RX = re.compile(r'main\.py forward -parent_port (\d+)')
+
+
+def trigrams(term):
+    padded = '  %s ' % term
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def build_entries(config):
+    entries = []
+    alias_ports = {}
+
+    for host_alias, conf in config['hosts'].items():
+        for username, alias in conf['users'].items():
+            alias_ports[alias] = conf['port']
+            entries.append({
+                'alias': alias, 'kind': 'host', 'user': username, 'host': conf['host'],
+                'port': conf['port'], 'host_alias': host_alias, 'parent_port': conf['port'],
+                'service_type': 'ssh', 'forward_mode': None,
+            })
+
+    for alias, conf in config.get('services', {}).items():
+        entries.append({
+            'alias': alias, 'kind': 'service', 'user': conf['sql_username'], 'host': conf['service_host'],
+            'port': conf['port'], 'host_alias': conf['remote_tunnel'],
+            'parent_port': alias_ports.get(conf['remote_tunnel']),
+            'service_type': conf['service_type'], 'forward_mode': conf.get('forward_mode', 'autossh'),
+        })
+
+    return entries
+
+
+class AliasIndex(object):
+    # rows, postings and term ids are kept as tuples and arrays so the
+    # pickled index loads in a few milliseconds even for large inventories
+
+    def __init__(self, entries):
+        self._rows = [tuple(entry[field] for field in ENTRY_FIELDS) for entry in entries]
+
+        terms = {}
+        for idx, entry in enumerate(entries):
+            for field in INDEX_FIELDS:
+                if entry[field]:
+                    terms.setdefault(str(entry[field]).lower(), set()).add(idx)
+
+        # every distinct term once, its entries are the run of _key_ids
+        # between its offset and the next one
+        self._keys = sorted(terms)
+        self._key_ids = array('I')
+        self._key_offsets = array('I', [0])
+        for term in self._keys:
+            self._key_ids.extend(sorted(terms[term]))
+            self._key_offsets.append(len(self._key_ids))
+
+        # all terms in one newline separated string, so substring search runs
+        # in C and every character maps straight back to its term
+        self._blob = '\n'.join(self._keys)
+        self._char_keys = array('I')
+        for key_pos, term in enumerate(self._keys):
+            self._char_keys.extend([key_pos] * (len(term) + 1))
+
+        postings = {}
+        for term, ids in terms.items():
+            for trigram in trigrams(term):
+                postings.setdefault(trigram, set()).update(ids)
+        self._trigrams = {trigram: array('I', sorted(ids)) for trigram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def entry(self, idx):
+        return dict(zip(ENTRY_FIELDS, self._rows[idx]))
+
+    def entries(self):
+        return [self.entry(idx) for idx in range(len(self._rows))]
+
+    def search(self, query, limit=None):
+        # exact matches rank first, then prefix, substring and fuzzy trigram hits,
+        # with a limit only the best scored entries are turned into dicts
+        query = query.lower()
+        scores = {}
+
+        # prefix and exact hits are contiguous runs of the sorted terms
+        prefix_start = bisect.bisect_left(self._keys, query)
+        prefix_end = bisect.bisect_left(self._keys, query + '\uffff', prefix_start)
+        exact_end = bisect.bisect_right(self._keys, query, prefix_start, prefix_end)
+
+        hits = {self._char_keys[match.start()] for match in re.finditer(re.escape(query), self._blob)}
+        for key_pos in hits:
+            if key_pos < prefix_start or key_pos >= prefix_end:
+                scores.update(dict.fromkeys(self._entry_ids(key_pos, key_pos + 1), 0.85))
+        scores.update(dict.fromkeys(self._entry_ids(exact_end, prefix_end), 0.9))
+        scores.update(dict.fromkeys(self._entry_ids(prefix_start, exact_end), 1.0))
+
+        # fuzzy hits only matter when the query did not match much literally,
+        # short queries have too few trigrams to tell a typo from noise
+        if len(query) >= 3 and len(scores) < MAX_FUZZY_RESULTS:
+            self._fuzzy_search(query, scores)
+
+        results = scores.items()
+        if limit is not None:
+            results = heapq.nlargest(limit, results, key=lambda r: r[1])
+
+        return [(score, self.entry(idx)) for idx, score in results]
+
+    def _entry_ids(self, start, end):
+        # entries of the terms start..end, which share one run of _key_ids
+        return self._key_ids[self._key_offsets[start]:self._key_offsets[end]]
+
+    def _fuzzy_search(self, query, scores):
+        # trigram hits are counted in C over every posting of the query, only
+        # the best MAX_FUZZY_RESULTS entries are scored
+        query_trigrams = trigrams(query)
+        counts = collections.Counter()
+        for trigram in query_trigrams:
+            counts.update(self._trigrams.get(trigram, ()))
+
+        needed = FUZZY_THRESHOLD * len(query_trigrams)
+        candidates = [(count, idx) for idx, count in counts.items() if count >= needed and idx not in scores]
+        for count, idx in heapq.nlargest(MAX_FUZZY_RESULTS, candidates):
+            scores[idx] = 0.8 * count / len(query_trigrams)
+
+
+def load_index():
+    # the index is rebuilt only when hosts.conf changes
+    st = os.stat(HOSTS_FILENAME)
+    key = (st.st_mtime_ns, st.st_size)
+
+    try:
+        with open(ALIAS_INDEX_FILENAME, 'rb') as f_obj:
+            cached_key, index = pickle.load(f_obj)
+        if cached_key == key:
+            return index
+    except Exception as e:
+        #missing or outdated cache, rebuilt below
+        pass
+
+    with open(HOSTS_FILENAME, 'r') as f_obj:
+        config = json.loads(f_obj.read())
+
+    index = AliasIndex(build_entries(config))
+
+    tmp_filename = '%s.%s' % (ALIAS_INDEX_FILENAME, os.getpid())
+    with open(tmp_filename, 'wb') as f_obj:
+        pickle.dump((key, index), f_obj, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, ALIAS_INDEX_FILENAME)
+
+    return index
+
+
+def get_live_status():
+    # one process listing for all rows instead of a pgrep per alias
+    try:
+        output = subprocess.check_output(['pgrep', '-af', 'ssh|main.py forward']).decode()
+    except subprocess.CalledProcessError:
+        output = ''
+
+    forwarded_ports = {int(port) for port in L_FORWARD_RX.findall(output)}
+    forwarder_ports = {int(port) for port in FORWARDER_RX.findall(output)}
+    return forwarded_ports, forwarder_ports
+
+
+def entry_status(entry, forwarded_ports, forwarder_ports):
+    if entry['kind'] == 'service' and entry['forward_mode'] != 'autossh':
+        active = entry['parent_port'] in forwarder_ports
+    else:
+        active = entry['port'] in forwarded_ports
+
+    return 'up' if active else 'down'
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import sys
+import socket
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    DEFAULT_SSH_PORT, YBER_TUNNEL, BASTIONS_FILENAME, BASTION_CACHE_TTL,
+    BASTION_PROBE_TIMEOUT, MAIN_TUNNEL_TIMEOUT,
+)
+from tunnel_lock import tunnel_lock, singleton_lock
+from transport import bastion_transport, transport_cmd
+from log_setup import log_fields
+
+log = logging.getLogger('stm')
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+WATCHDOG_LOCK = 'watchdog_running'
+
+
+def get_bastions(host_conf):
+    return host_conf.get('bastions') or [YBER_TUNNEL]
+
+
+def split_bastion(bastion):
+    # bastions are stored as user@host or user@host:port
+    destination, _, port = bastion.partition(':')
+    hostname = destination.split('@')[-1]
+    return destination, hostname, int(port or DEFAULT_SSH_PORT)
+
+
+def bastion_ssh_args(bastion):
+    destination, hostname, port = split_bastion(bastion)
+    if port != DEFAULT_SSH_PORT:
+        return '-p %s %s' % (port, destination)
+    return destination
+
+
+def read_ssh_banner(host, port, timeout):
+    started = time.time()
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            banner = sock.recv(256)
+    except (OSError, socket.timeout):
+        return None
+
+    if not banner.startswith(b'SSH-'):
+        return None
+
+    return time.time() - started
+
+
+def probe_bastion(bastion):
+    destination, hostname, port = split_bastion(bastion)
+    return read_ssh_banner(hostname, port, BASTION_PROBE_TIMEOUT)
+
+
+def probe_bastions(bastions):
+    if not bastions:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(bastions)) as executor:
+        return dict(zip(bastions, executor.map(probe_bastion, bastions)))
+
+
+def _load_cache():
+    try:
+        with open(BASTIONS_FILENAME, 'r') as f_obj:
+            return json.loads(f_obj.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_cache(cache):
+    tmp_filename = '%s.%s' % (BASTIONS_FILENAME, os.getpid())
+    with open(tmp_filename, 'w') as f_obj:
+        f_obj.write(json.dumps(cache))
+    os.replace(tmp_filename, BASTIONS_FILENAME)
+
+
+def rank_bastions(bastions):
+    now = time.time()
+    cache = _load_cache()
+    stale = [b for b in bastions if now - cache.get(b, {}).get('checked', 0) > BASTION_CACHE_TTL]
+
+    if stale:
+        for bastion, rtt in probe_bastions(stale).items():
+            cache[bastion] = {'rtt': rtt, 'checked': now}
+            log.info('Probed bastion %s, rtt: %s' % (bastion, rtt),
+                     extra=dict(log_fields(bastion, 'bastion_probe', 'down' if rtt is None else 'up'), duration=rtt))
+        _write_cache(cache)
+
+    healthy = [b for b in bastions if cache[b]['rtt'] is not None]
+    if not healthy:
+        # banner probes can be filtered while ssh itself works, so fall back
+        # to the configured order instead of giving up
+        log.warning('No bastion answered the probe, trying all of %s' % bastions)
+        return list(bastions)
+
+    return sorted(healthy, key=lambda b: cache[b]['rtt'])
+
+
+def mark_bastion_down(bastion):
+    cache = _load_cache()
+    cache[bastion] = {'rtt': None, 'checked': time.time()}
+    _write_cache(cache)
+
+
+def is_main_tunnel_active(parent_host, parent_port):
+    try:
+        tunnel_uri = '%s:%s' % (parent_port, parent_host)
+        subprocess.check_output(['pgrep', '-f', tunnel_uri])
+    except Exception as e:
+        #exception expected here, hence no logging
+        return False
+
+    return True
+
+
+def is_main_tunnel_alive(parent_port):
+    return read_ssh_banner('127.0.0.1', parent_port, BASTION_PROBE_TIMEOUT) is not None
+
+
+def get_tunnel_bastion(parent_host, parent_port, bastions):
+    try:
+        tunnel_uri = '%s:%s' % (parent_port, parent_host)
+        output = subprocess.check_output(['pgrep', '-af', tunnel_uri]).decode()
+    except Exception as e:
+        return None
+
+    for bastion in bastions:
+        if bastion_ssh_args(bastion) in output:
+            return bastion
+
+    return None
+
+
+def kill_main_tunnel(parent_host, parent_port):
+    tunnel_uri = '%s:%s' % (parent_port, parent_host)
+    subprocess.call(['pkill', '-f', tunnel_uri])
+
+
+def construct_main_tunnel(alias, parent_host, parent_port, bastions, transport):
+    for bastion in rank_bastions(bastions):
+        started = time.time()
+        main_ssh_tunnel_cmd = 'autossh -M 0 -f -N%s -L %s:%s:%s %s' % (
+            transport_cmd(bastion_transport(transport)), parent_port, parent_host, 22, bastion_ssh_args(bastion))
+
+        try:
+            subprocess.call(main_ssh_tunnel_cmd, shell=True)
+        except:
+            log.exception('Failed to build main tunnel for %s [%s]' %
+                    (alias, main_ssh_tunnel_cmd), extra=log_fields(alias, 'main_tunnel', 'error', started))
+            continue
+
+        deadline = time.time() + MAIN_TUNNEL_TIMEOUT
+        while time.time() < deadline:
+            if is_main_tunnel_alive(parent_port):
+                log.info('Created main tunnel for %s [%s]' %
+                        (alias, main_ssh_tunnel_cmd), extra=log_fields(alias, 'main_tunnel', 'created', started))
+                return bastion
+            time.sleep(0.2)
+
+        log.error('Main tunnel for %s did not come up through %s, failing over' %
+                (alias, bastion), extra=log_fields(alias, 'main_tunnel', 'timeout', started))
+        kill_main_tunnel(parent_host, parent_port)
+        mark_bastion_down(bastion)
+
+    return None
+
+
+def is_watchdog_running():
+    # the watchdog holds its lock for as long as it runs, however it was started
+    with singleton_lock(WATCHDOG_LOCK) as acquired:
+        return not acquired
+
+
+def ensure_watchdog():
+    with tunnel_lock('watchdog'):
+        if is_watchdog_running():
+            return
+
+        subprocess.Popen(
+            [sys.executable, MAIN_SCRIPT, 'watch'],
+            start_new_session=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+
+def ensure_main_tunnel(alias, parent_host, parent_port, bastions, transport):
+    # concurrent launches wait for a single creator and then share its tunnel
+    with tunnel_lock('main_%s' % parent_port):
+        created = _ensure_main_tunnel(alias, parent_host, parent_port, bastions, transport)
+
+    # with more than one bastion a dead tunnel is moved over right away
+    # instead of waiting for the next stm command
+    if created and len(bastions) > 1:
+        ensure_watchdog()
+
+    return created
+
+
+def _ensure_main_tunnel(alias, parent_host, parent_port, bastions, transport):
+    if is_main_tunnel_active(parent_host, parent_port):
+        if is_main_tunnel_alive(parent_port):
+            return True
+
+        bastion = get_tunnel_bastion(parent_host, parent_port, bastions)
+        log.error('Main tunnel for %s is not answering [bastion: %s], failing over' %
+                (alias, bastion), extra=log_fields(alias, 'main_tunnel', 'dead'))
+        kill_main_tunnel(parent_host, parent_port)
+        if bastion:
+            mark_bastion_down(bastion)
+
+    return construct_main_tunnel(alias, parent_host, parent_port, bastions, transport) is not None
@@ -0,0 +1,72 @@
+import json
+import logging
+import subprocess
+
+from config import HOSTS_FILENAME
+from bastion import kill_main_tunnel
+from forwarder import FORWARDER_MODES, get_socks_port, stop_forwarder, stop_mux_master
+from session_store import forget_main_tunnel, forget_service_tunnel
+from log_setup import log_fields
+
+log = logging.getLogger('stm')
+
+
+class CloseHandler(object):
+    # closing a tunnel on purpose is what takes it out of the snapshot,
+    # tunnels that merely died stay there for stm restore
+    @classmethod
+    def __init__(cls, alias):
+        cls._alias = alias
+
+        try:
+            with open(HOSTS_FILENAME, 'r') as f_obj:
+                cls._config = json.loads(f_obj.read())
+        except IOError as e:
+            log.error('Hosts file is missing...')
+            return
+        except Exception as e:
+            log.exception('Got unexpected exception @ loading conf')
+            return
+
+        if cls._alias in cls._config.get('services', {}):
+            cls._close_service(cls._alias, cls._config['services'][cls._alias])
+            return
+
+        for host_alias, conf in cls._config['hosts'].items():
+            if cls._alias in conf['users'].values():
+                cls._close_host(conf)
+                return
+
+        log.error('Alias not found')
+        print('Alias not found')
+
+    @classmethod
+    def _close_service(cls, alias, conf):
+        if conf.get('forward_mode', 'autossh') in FORWARDER_MODES:
+            # the forwarder of the host serves all of its services and stops
+            # together with the host tunnel
+            print('%s stays reachable until its host tunnel is closed' % alias)
+        else:
+            subprocess.call(['pkill', '-f', '%s:%s' % (conf['port'], conf['service_host'])])
+
+        forget_service_tunnel(alias)
+        log.info('Closed service tunnel %s' % alias, extra=log_fields(alias, 'close_service', 'closed'))
+        print('Closed %s' % alias)
+
+    @classmethod
+    def _close_host(cls, conf):
+        reversed_users_conf = {v: k for k, v in conf['users'].items()}
+
+        for service_alias, service_conf in cls._config.get('services', {}).items():
+            if service_conf['remote_tunnel'] in reversed_users_conf:
+                cls._close_service(service_alias, service_conf)
+
+        stop_forwarder(conf['port'])
+        subprocess.call(['pkill', '-f', '127.0.0.1:%s ' % get_socks_port(conf)])
+        for user in reversed_users_conf.values():
+            stop_mux_master(user, conf['port'])
+
+        kill_main_tunnel(conf['host'], conf['port'])
+        forget_main_tunnel(conf['port'])
+        log.info('Closed main tunnel of %s' % cls._alias, extra=log_fields(cls._alias, 'close_main', 'closed'))
+        print('Closed %s' % cls._alias)
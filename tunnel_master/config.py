@@ -5,15 +5,47 @@ APP_NAME = 'ssh_tunnel_master'
 APP_DIR = os.path.join(os.getenv('HOME'), '.local/share/' + APP_NAME)
 LOG_DIR = os.path.join(APP_DIR, 'logs')
 LOG_FILENAME = os.path.join(LOG_DIR, APP_NAME + '.log')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR',)
+LOG_LEVEL = os.getenv('STM_LOG_LEVEL', 'DEBUG').upper()
+if LOG_LEVEL not in LOG_LEVELS:
+    LOG_LEVEL = 'DEBUG'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
 SSH_FILENAME = os.path.join(os.getenv('HOME'), '.ssh', 'known_hosts')
 BASHRC_FILENAME = os.path.join(os.getenv('HOME'), '.bashrc')
 ALIASES_FILENAME = os.path.join(os.getenv('HOME'), '.bash_aliases')
 SSH_TUNNEL_MASTER_ALIASES = os.path.join(os.getenv('HOME'), '.bash_stm_aliases')
 HOSTS_FILENAME = os.path.join(APP_DIR, 'hosts.conf')
 YBER_TUNNEL = 'maksko@ybershell.estpak.ee'
+BASTIONS_FILENAME = os.path.join(APP_DIR, 'bastions.json')
+BASTION_CACHE_TTL = 300
+BASTION_PROBE_TIMEOUT = 3
+MAIN_TUNNEL_TIMEOUT = 10
+WATCHDOG_INTERVAL = 15
+WATCHDOG_MISSES = 2
+WATCHDOG_LOAD_FAILURES = 4
+SOCKS_PORT_OFFSET = 1
+FORWARDER_TIMEOUT = 5
+FORWARDER_STATS_INTERVAL = 5
+MUX_DIR = os.path.join(APP_DIR, 'mux')
+LOCK_DIR = os.path.join(APP_DIR, 'locks')
+MANIFESTS_DIR = os.path.join(APP_DIR, 'manifests')
+SESSIONS_FILENAME = os.path.join(APP_DIR, 'sessions.json')
+SERVICE_STATS_FILENAME = os.path.join(APP_DIR, 'service_stats.json')
+READINESS_TIMEOUT = 10
+ALIAS_INDEX_FILENAME = os.path.join(APP_DIR, 'alias_index.pickle')
 
 if not os.access(APP_DIR, os.F_OK):
     os.mkdir(APP_DIR)
 
 if not os.access(LOG_DIR, os.F_OK):
     os.mkdir(LOG_DIR)
+
+if not os.access(MUX_DIR, os.F_OK):
+    os.mkdir(MUX_DIR)
+
+if not os.access(LOCK_DIR, os.F_OK):
+    os.mkdir(LOCK_DIR)
+
+if not os.access(MANIFESTS_DIR, os.F_OK):
+    os.mkdir(MANIFESTS_DIR)
@@ -0,0 +1,380 @@
+#! /usr/bin/python3
+# This module is also executed on the remote end with "python3 -c", so it
+# must not depend on anything outside the standard library.
+
+import os
+import sys
+import json
+import mmap
+import stat
+import zlib
+import struct
+import hashlib
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_OPS = 4096
+MAX_ROLLING_MISSES = 8
+ADLER_MOD = 65521
+TMP_SUFFIX = '.stm-sync'
+
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError('Stream closed after %s of %s bytes' % (len(data), size))
+        data += chunk
+
+    return data
+
+
+def write_frame(stream, header, payload=b''):
+    if payload:
+        header['size'] = len(payload)
+    data = json.dumps(header).encode()
+    stream.write(struct.pack('!I', len(data)) + data)
+    if payload:
+        stream.write(payload)
+
+
+def read_frame(stream):
+    length = struct.unpack('!I', read_exactly(stream, 4))[0]
+    header = json.loads(read_exactly(stream, length).decode())
+    payload = read_exactly(stream, header['size']) if header.get('size') else b''
+    return header, payload
+
+
+def block_size_for(size):
+    block_size = 1 << int(size ** 0.5).bit_length()
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, block_size))
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=8).hexdigest()
+
+
+def join_root(root, rel):
+    # a root that is a single file is listed under the empty relative path
+    return os.path.join(root, rel) if rel else root
+
+
+def _manifest_entry(st):
+    return [st.st_size, int(st.st_mtime), stat.S_IMODE(st.st_mode)]
+
+
+def build_manifest(root):
+    # returns None for a missing root, a file root is a one entry manifest
+    if os.path.isfile(root):
+        return {'': _manifest_entry(os.stat(root))}
+    elif not os.path.isdir(root):
+        return None
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(TMP_SUFFIX):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+
+            if stat.S_ISREG(st.st_mode):
+                files[os.path.relpath(path, root)] = _manifest_entry(st)
+
+    return files
+
+
+def build_signature(path, block_size):
+    signature = []
+    with open(path, 'rb') as f_obj:
+        while True:
+            block = f_obj.read(block_size)
+            if not block:
+                break
+            signature.append([zlib.adler32(block), strong_checksum(block)])
+
+    return signature
+
+
+def _lookup(index, weak, block):
+    candidates = index.get(weak)
+    if candidates:
+        return candidates.get(strong_checksum(block))
+
+    return None
+
+
+def _roll(mm, pos, size, block_size, weak, index):
+    # slide the window one byte at a time looking for a block that moved,
+    # adler32 is updated in O(1) per byte instead of being recomputed
+    a = weak & 0xffff
+    b = weak >> 16
+    for start in range(pos + 1, min(pos + block_size, size - block_size) + 1):
+        byte_out = mm[start - 1]
+        a = (a - byte_out + mm[start + block_size - 1]) % ADLER_MOD
+        b = (b - block_size * byte_out + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        if weak in index:
+            idx = _lookup(index, weak, mm[start:start + block_size])
+            if idx is not None:
+                return start, idx
+
+    return None, None
+
+
+class _DeltaChunk(object):
+
+    def __init__(self):
+        self.ops = []
+        self.payload = []
+        self.payload_size = 0
+
+    def add_copy(self, idx):
+        if self.ops and self.ops[-1][0] == 'c' and self.ops[-1][1] + self.ops[-1][2] == idx:
+            self.ops[-1][2] += 1
+        else:
+            self.ops.append(['c', idx, 1])
+
+    def add_literal(self, data):
+        self.ops.append(['d', len(data)])
+        self.payload.append(data)
+        self.payload_size += len(data)
+
+    def is_full(self):
+        return self.payload_size >= CHUNK_SIZE or len(self.ops) >= MAX_CHUNK_OPS
+
+    def frame(self):
+        return {'ops': self.ops}, b''.join(self.payload)
+
+
+def iter_delta(path, block_size, signature):
+    # yields (header, payload) frames turning the signed file into this one,
+    # the last frame carries the digest of the whole file
+    index = {}
+    for idx, (weak, strong) in enumerate(signature):
+        index.setdefault(weak, {}).setdefault(strong, idx)
+
+    digest = hashlib.md5()
+    chunk = _DeltaChunk()
+
+    with open(path, 'rb') as f_obj:
+        size = os.fstat(f_obj.fileno()).st_size
+
+        if not index or not size:
+            while True:
+                data = f_obj.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                chunk.add_literal(data)
+                yield chunk.frame()
+                chunk = _DeltaChunk()
+
+            yield {'done': True, 'digest': digest.hexdigest()}, b''
+            return
+
+        with mmap.mmap(f_obj.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            digest.update(mm)
+            pos = literal_start = misses = 0
+            retry_at = MAX_ROLLING_MISSES
+
+            while pos < size:
+                end = min(pos + block_size, size)
+                block = mm[pos:end]
+                weak = zlib.adler32(block)
+                match_pos, idx = pos, _lookup(index, weak, block)
+
+                # after MAX_ROLLING_MISSES misses in a row the rolling search is
+                # retried with doubling spacing, a rewritten file costs a handful
+                # of rolls and the blocks after a long insertion are still found
+                rolling = misses < MAX_ROLLING_MISSES or misses == retry_at
+                if misses == retry_at:
+                    retry_at *= 2
+                if idx is None and end - pos == block_size and rolling:
+                    match_pos, idx = _roll(mm, pos, size, block_size, weak, index)
+
+                if idx is None:
+                    misses += 1
+                    pos = end
+                    continue
+
+                for literal_pos in range(literal_start, match_pos, CHUNK_SIZE):
+                    chunk.add_literal(mm[literal_pos:min(literal_pos + CHUNK_SIZE, match_pos)])
+                    if chunk.is_full():
+                        yield chunk.frame()
+                        chunk = _DeltaChunk()
+
+                chunk.add_copy(idx)
+                if chunk.is_full():
+                    yield chunk.frame()
+                    chunk = _DeltaChunk()
+
+                misses = 0
+                retry_at = MAX_ROLLING_MISSES
+                pos = literal_start = min(match_pos + block_size, size)
+
+            for literal_pos in range(literal_start, size, CHUNK_SIZE):
+                chunk.add_literal(mm[literal_pos:min(literal_pos + CHUNK_SIZE, size)])
+                if chunk.is_full():
+                    yield chunk.frame()
+                    chunk = _DeltaChunk()
+
+    if chunk.ops:
+        yield chunk.frame()
+
+    yield {'done': True, 'digest': digest.hexdigest()}, b''
+
+
+def apply_delta(path, block_size, frames, mtime, mode):
+    dirname, basename = os.path.split(path)
+    tmp_path = os.path.join(dirname, '.' + basename + TMP_SUFFIX)
+    os.makedirs(dirname or '.', exist_ok=True)
+    digest = hashlib.md5()
+
+    old_f_obj = open(path, 'rb') if os.path.isfile(path) else None
+    try:
+        with open(tmp_path, 'wb') as f_obj:
+            for header, payload in frames:
+                if header.get('done'):
+                    if header['digest'] != digest.hexdigest():
+                        raise ValueError('Checksum mismatch after patching %s' % path)
+                    break
+
+                view = memoryview(payload)
+                offset = 0
+                for op in header['ops']:
+                    if op[0] == 'c':
+                        old_f_obj.seek(op[1] * block_size)
+                        data = old_f_obj.read(op[2] * block_size)
+                    else:
+                        data = view[offset:offset + op[1]]
+                        offset += op[1]
+                    digest.update(data)
+                    f_obj.write(data)
+    except:
+        os.unlink(tmp_path)
+        raise
+    finally:
+        if old_f_obj:
+            old_f_obj.close()
+
+    os.chmod(tmp_path, mode)
+    os.utime(tmp_path, (mtime, mtime))
+    os.replace(tmp_path, path)
+
+
+class LocalEndpoint(object):
+
+    def __init__(self, cache=None):
+        # cache maps absolute paths to previously computed signatures
+        self._cache = cache if cache is not None else {}
+
+    def manifest(self, root):
+        return build_manifest(os.path.expanduser(root))
+
+    def signature(self, root, rel, block_size):
+        path = join_root(os.path.expanduser(root), rel)
+        st = os.stat(path)
+        key = [st.st_size, int(st.st_mtime), block_size]
+
+        cached = self._cache.get(path)
+        if cached and cached['key'] == key:
+            return cached['signature']
+
+        signature = build_signature(path, block_size)
+        self._cache[path] = {'key': key, 'signature': signature}
+        return signature
+
+    def delta(self, root, rel, block_size, signature):
+        return iter_delta(join_root(os.path.expanduser(root), rel), block_size, signature)
+
+    def patch(self, root, rel, block_size, mtime, mode, frames):
+        path = join_root(os.path.expanduser(root), rel)
+        self._cache.pop(path, None)
+        apply_delta(path, block_size, frames, mtime, mode)
+
+
+def _iter_request_frames(stream):
+    while True:
+        header, payload = read_frame(stream)
+        yield header, payload
+        if header.get('done'):
+            break
+
+
+def serve(stdin, stdout):
+    endpoint = LocalEndpoint()
+
+    while True:
+        header, payload = read_frame(stdin)
+        op = header['op']
+        if op == 'quit':
+            break
+
+        try:
+            if op == 'manifest':
+                write_frame(stdout, {'files': endpoint.manifest(header['root'])})
+            elif op == 'signature':
+                signature = endpoint.signature(header['root'], header['rel'], header['block_size'])
+                write_frame(stdout, {'signature': signature})
+            elif op == 'delta':
+                frames = endpoint.delta(header['root'], header['rel'], header['block_size'], header['signature'])
+                for frame_header, frame_payload in frames:
+                    write_frame(stdout, frame_header, frame_payload)
+            elif op == 'patch':
+                frames = _iter_request_frames(stdin)
+                try:
+                    endpoint.patch(header['root'], header['rel'], header['block_size'],
+                                   header['mtime'], header['mode'], frames)
+                finally:
+                    # keep the stream in sync even if patching failed midway
+                    for frame in frames:
+                        pass
+                write_frame(stdout, {'done': True})
+            else:
+                write_frame(stdout, {'error': 'Unknown op %s' % op})
+        except Exception as e:
+            write_frame(stdout, {'error': '%s: %s' % (e.__class__.__name__, e)})
+
+        stdout.flush()
+
+
+def sync_tree(source, source_root, destination, destination_root):
+    stats = {'files': 0, 'skipped': 0, 'transferred': 0, 'literal_bytes': 0, 'matched_bytes': 0}
+    source_files = source.manifest(source_root)
+    if source_files is None:
+        raise FileNotFoundError('Nothing to sync, %s does not exist' % source_root)
+
+    destination_files = destination.manifest(destination_root) or {}
+
+    for rel, (size, mtime, mode) in sorted(source_files.items()):
+        stats['files'] += 1
+        existing = destination_files.get(rel)
+        if existing and existing[:2] == [size, mtime]:
+            stats['skipped'] += 1
+            continue
+
+        block_size = block_size_for(size)
+        signature = destination.signature(destination_root, rel, block_size) if existing else []
+
+        def counted(frames):
+            for header, payload in frames:
+                stats['literal_bytes'] += len(payload)
+                stats['matched_bytes'] += sum(op[2] for op in header.get('ops', ()) if op[0] == 'c') * block_size
+                yield header, payload
+
+        frames = counted(source.delta(source_root, rel, block_size, signature))
+        destination.patch(destination_root, rel, block_size, mtime, mode, frames)
+        stats['transferred'] += 1
+
+    return stats
+
+
+if __name__ == '__main__' and sys.argv[1:] == ['serve']:
+    serve(sys.stdin.buffer, sys.stdout.buffer)
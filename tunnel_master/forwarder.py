@@ -0,0 +1,380 @@
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import signal
+import struct
+import asyncio
+import logging
+import resource
+import subprocess
+
+from config import (
+    APP_DIR, HOSTS_FILENAME, MUX_DIR, SOCKS_PORT_OFFSET, FORWARDER_TIMEOUT,
+    FORWARDER_STATS_INTERVAL,
+)
+
+log = logging.getLogger('stm')
+
+FORWARD_MODES = ('autossh', 'socks', 'mux',)
+FORWARDER_MODES = ('socks', 'mux',)
+RELAY_BUFFER_SIZE = 64 * 1024
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def get_socks_port(host_conf):
+    return host_conf.get('socks_port', host_conf['port'] + SOCKS_PORT_OFFSET)
+
+
+def get_stats_filename(parent_port):
+    return os.path.join(APP_DIR, 'forwarder_%s.json' % parent_port)
+
+
+def load_forwarder_stats():
+    stats = {}
+    for filename in glob.glob(os.path.join(APP_DIR, 'forwarder_*.json')):
+        try:
+            with open(filename, 'r') as f_obj:
+                stats.update(json.loads(f_obj.read()))
+        except (IOError, ValueError):
+            continue
+
+    return stats
+
+
+def is_port_listening(port):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if is_port_listening(port):
+            return True
+        time.sleep(0.1)
+
+    return False
+
+
+def mux_ssh_args(user, parent_port):
+    control_path = os.path.join(MUX_DIR, '%s@%s' % (user, parent_port))
+    return ['-S', control_path, '-p', str(parent_port), '%s@localhost' % user]
+
+
+def is_mux_master_active(user, parent_port):
+    status = subprocess.call(
+        ['ssh', '-O', 'check'] + mux_ssh_args(user, parent_port),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return status == 0
+
+
+def stop_mux_master(user, parent_port):
+    subprocess.call(
+        ['ssh', '-O', 'exit'] + mux_ssh_args(user, parent_port),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def construct_mux_master(user, parent_port, ssh_options=()):
+    if is_mux_master_active(user, parent_port):
+        return True
+
+    mux_master_cmd = ['ssh', '-M', '-f', '-N', '-o', 'ControlPersist=yes'] + list(ssh_options)
+    mux_master_cmd += mux_ssh_args(user, parent_port)
+    try:
+        subprocess.check_call(mux_master_cmd)
+        log.info('Created mux master [%s]' % ' '.join(mux_master_cmd))
+    except:
+        log.exception('Failed to build mux master [%s]' % ' '.join(mux_master_cmd))
+        return False
+
+    return True
+
+
+def load_forwards(parent_port):
+    # every socks and mux service riding on the host with the given parent
+    # port, keyed by the local port the service is published on
+    with open(HOSTS_FILENAME, 'r') as f_obj:
+        config = json.loads(f_obj.read())
+
+    host_conf = None
+    for host_alias, conf in config['hosts'].items():
+        if conf['port'] == parent_port:
+            host_conf = conf
+            break
+
+    if host_conf is None:
+        return None, {}
+
+    reversed_users_conf = {v: k for k, v in host_conf['users'].items()}
+    forwards = {}
+    for service_alias, conf in config.get('services', {}).items():
+        if conf['remote_tunnel'] not in reversed_users_conf:
+            continue
+        if conf.get('forward_mode') not in FORWARDER_MODES:
+            continue
+        forwards[conf['port']] = {
+            'alias': service_alias,
+            'mode': conf['forward_mode'],
+            'user': reversed_users_conf[conf['remote_tunnel']],
+            'service_host': conf['service_host'],
+            'service_port': conf['service_port'],
+        }
+
+    return host_conf, forwards
+
+
+async def _recv_exactly(loop, sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed during handshake')
+        data += chunk
+
+    return data
+
+
+async def open_socks_socket(loop, socks_port, host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+
+    try:
+        await loop.sock_connect(sock, ('127.0.0.1', socks_port))
+        await loop.sock_sendall(sock, b'\x05\x01\x00')
+        version, method = await _recv_exactly(loop, sock, 2)
+        if version != 5 or method != 0:
+            raise ConnectionError('SOCKS proxy refused no-auth method')
+
+        host_bytes = host.encode()
+        await loop.sock_sendall(sock, b'\x05\x01\x00\x03' + bytes([len(host_bytes)]) + host_bytes + struct.pack('!H', port))
+        version, reply, _, address_type = await _recv_exactly(loop, sock, 4)
+        if reply != 0:
+            raise ConnectionError('SOCKS connect to %s:%s failed with code %s' % (host, port, reply))
+
+        if address_type == 1:
+            await _recv_exactly(loop, sock, 4 + 2)
+        elif address_type == 4:
+            await _recv_exactly(loop, sock, 16 + 2)
+        else:
+            address_length = (await _recv_exactly(loop, sock, 1))[0]
+            await _recv_exactly(loop, sock, address_length + 2)
+    except:
+        sock.close()
+        raise
+
+    return sock, None
+
+
+async def open_mux_socket(user, parent_port, host, port):
+    # ssh -W opens a direct-tcpip channel over the shared master connection,
+    # one end of a socketpair is its stdio so relaying stays socket to socket
+    local_sock, remote_sock = socket.socketpair()
+    local_sock.setblocking(False)
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'ssh', '-W', '%s:%s' % (host, port), *mux_ssh_args(user, parent_port),
+            stdin=remote_sock, stdout=remote_sock, stderr=subprocess.DEVNULL,
+        )
+    except:
+        local_sock.close()
+        raise
+    finally:
+        remote_sock.close()
+
+    return local_sock, proc
+
+
+async def relay(loop, src, dst, stats, key):
+    buf = bytearray(RELAY_BUFFER_SIZE)
+    view = memoryview(buf)
+
+    try:
+        while True:
+            size = await loop.sock_recv_into(src, buf)
+            if not size:
+                break
+            await loop.sock_sendall(dst, view[:size])
+            stats[key] += size
+    except OSError:
+        pass
+    finally:
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class Forwarder(object):
+
+    def __init__(self, parent_port):
+        self._parent_port = parent_port
+        self._socks_port = None
+        self._servers = {}
+        self._stats = {}
+        self._stopped = None
+
+    def run(self):
+        # every relayed connection holds two descriptors
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self._sync_servers()))
+        loop.add_signal_handler(signal.SIGTERM, self._stopped.set)
+
+        await self._sync_servers()
+        stats_task = loop.create_task(self._write_stats())
+        await self._stopped.wait()
+
+        stats_task.cancel()
+        for port in list(self._servers):
+            self._close_server(port)
+
+    async def _sync_servers(self):
+        try:
+            host_conf, forwards = load_forwards(self._parent_port)
+        except Exception as e:
+            log.exception('Forwarder for %s failed to load conf' % self._parent_port)
+            return
+
+        if host_conf is None:
+            log.error('Forwarder found no host for parent port %s' % self._parent_port)
+            self._stopped.set()
+            return
+
+        self._socks_port = get_socks_port(host_conf)
+
+        for port in set(self._servers) - set(forwards):
+            self._close_server(port)
+
+        loop = asyncio.get_running_loop()
+        for port, forward in forwards.items():
+            if port in self._servers:
+                continue
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(('127.0.0.1', port))
+                sock.listen(1024)
+            except OSError as e:
+                sock.close()
+                log.error('Forwarder failed to listen on %s for %s: %s' % (port, forward['alias'], e))
+                continue
+
+            sock.setblocking(False)
+            self._stats.setdefault(forward['alias'], {
+                'port': port, 'mode': forward['mode'],
+                'connections': 0, 'active': 0, 'bytes_in': 0, 'bytes_out': 0,
+            })
+            self._servers[port] = (sock, loop.create_task(self._accept(sock, forward)))
+            log.info('Forwarder listening on %s for %s [%s:%s]' % (
+                port, forward['alias'], forward['service_host'], forward['service_port'])
+            )
+
+    def _close_server(self, port):
+        sock, task = self._servers.pop(port)
+        task.cancel()
+        sock.close()
+        log.info('Forwarder stopped listening on %s' % port)
+
+    async def _accept(self, sock, forward):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client, address = await loop.sock_accept(sock)
+            except OSError as e:
+                log.error('Forwarder failed to accept on %s: %s' % (forward['alias'], e))
+                await asyncio.sleep(0.1)
+                continue
+
+            client.setblocking(False)
+            loop.create_task(self._handle(client, forward))
+
+    async def _handle(self, client, forward):
+        loop = asyncio.get_running_loop()
+        stats = self._stats[forward['alias']]
+
+        try:
+            if forward['mode'] == 'mux':
+                remote, proc = await open_mux_socket(
+                    forward['user'], self._parent_port, forward['service_host'], forward['service_port'])
+            else:
+                remote, proc = await open_socks_socket(
+                    loop, self._socks_port, forward['service_host'], forward['service_port'])
+        except (OSError, ConnectionError) as e:
+            log.error('Forwarder failed to reach %s [%s:%s]: %s' % (
+                forward['alias'], forward['service_host'], forward['service_port'], e)
+            )
+            client.close()
+            return
+
+        stats['connections'] += 1
+        stats['active'] += 1
+        try:
+            await asyncio.gather(
+                relay(loop, client, remote, stats, 'bytes_out'),
+                relay(loop, remote, client, stats, 'bytes_in'),
+            )
+        finally:
+            stats['active'] -= 1
+            client.close()
+            remote.close()
+            if proc is not None:
+                await proc.wait()
+
+    async def _write_stats(self):
+        stats_filename = get_stats_filename(self._parent_port)
+        while True:
+            with open(stats_filename + '.tmp', 'w') as f_obj:
+                f_obj.write(json.dumps(self._stats))
+            os.replace(stats_filename + '.tmp', stats_filename)
+            await asyncio.sleep(FORWARDER_STATS_INTERVAL)
+
+
+def _forwarder_pattern(parent_port):
+    return 'main.py forward -parent_port %s$' % parent_port
+
+
+def is_forwarder_running(parent_port):
+    try:
+        subprocess.check_output(['pgrep', '-f', _forwarder_pattern(parent_port)])
+    except Exception as e:
+        #exception expected here, hence no logging
+        return False
+
+    return True
+
+
+def stop_forwarder(parent_port):
+    subprocess.call(['pkill', '-f', _forwarder_pattern(parent_port)])
+
+
+def ensure_forwarder(parent_port, local_port):
+    if is_port_listening(local_port):
+        return True
+
+    if is_forwarder_running(parent_port):
+        # a running forwarder picks up newly configured services on SIGHUP
+        subprocess.call(['pkill', '-HUP', '-f', _forwarder_pattern(parent_port)])
+    else:
+        subprocess.Popen(
+            [sys.executable, MAIN_SCRIPT, 'forward', '-parent_port', str(parent_port)],
+            start_new_session=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    return wait_for_port(local_port, FORWARDER_TIMEOUT)
@@ -0,0 +1,109 @@
+import os
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import multiprocessing.util
+
+from config import LOG_FILENAME, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT
+
+log = logging.getLogger('stm')
+
+EVENT_FIELDS = ('alias', 'phase', 'duration', 'outcome',)
+
+_queue = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        event = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        for field in EVENT_FIELDS:
+            if hasattr(record, field):
+                event[field] = getattr(record, field)
+        if getattr(record, 'exc', None):
+            event['exc'] = record.exc
+        elif record.exc_info:
+            event['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(event)
+
+
+class EventQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # the stock prepare folds the traceback into msg, it is kept apart
+        # here so the listener can write it as its own field
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc = JsonFormatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.exc_text = None
+
+        return record
+
+
+def log_fields(alias, phase, outcome, started=None):
+    # extra= payload for structured events, duration is measured from started
+    fields = {'alias': alias, 'phase': phase, 'outcome': outcome}
+    if started is not None:
+        fields['duration'] = round(time.time() - started, 6)
+
+    return fields
+
+
+def _start_listener():
+    global _queue, _listener
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILENAME, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+
+    _queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+
+    for handler in list(log.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            log.removeHandler(handler)
+    log.addHandler(EventQueueHandler(_queue))
+
+
+def _stop_listener():
+    # drains the queue, records put before this are all written
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_listener_in_child():
+    # the listener thread does not survive fork, worker processes need their own
+    if _listener is not None:
+        _start_listener()
+
+
+def setup_worker_logging():
+    # process pool initializer, workers leave through os._exit which skips
+    # atexit, so the queue is drained by a multiprocessing finalizer instead
+    multiprocessing.util.Finalize(None, _stop_listener, exitpriority=0)
+
+
+def setup_logging(level=None):
+    # file writes and rotation happen on the listener thread, callers only
+    # pay for putting the record on the queue
+    log.setLevel(level or LOG_LEVEL)
+    _start_listener()
+    atexit.register(_stop_listener)
+
+
+os.register_at_fork(after_in_child=_restart_listener_in_child)
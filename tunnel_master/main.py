@@ -1,5 +1,6 @@
 #! /usr/bin/python3
 
+import sys
 import json
 import logging
 import argparse
@@ -8,20 +9,73 @@ import logging.handlers
 from stm_agent import StmAgent
 from scp_handler import ScpHandler
 from ssh_handler import SshTunnelHandler
-from config import DEFAULT_SSH_PORT, APP_DIR, LOG_FILENAME, YBER_TUNNEL, HOSTS_FILENAME
+from sync_handler import SyncHandler
+from tune_handler import TuneHandler
+from restore_handler import RestoreHandler
+from close_handler import CloseHandler
+from forwarder import Forwarder, load_forwarder_stats
+from watchdog import Watchdog
+from readiness import load_service_stats
+from alias_index import load_index, get_live_status, entry_status
+from session_launcher import BACKENDS
+from log_setup import setup_logging
+from config import LOG_LEVELS
 
 log = logging.getLogger('stm')
-log.setLevel(logging.DEBUG)
-handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=10*1024*1024, backupCount=5)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-log.addHandler(handler)
 
 KONSOLE_SESSION_PATH = 'org.kde.konsole.Session'
+INFO_FIELDS = ('alias', 'kind', 'user', 'host', 'port', 'service_type', 'host_alias',)
+
+
+def print_aliases(query, output_format, sort_key, with_status, limit):
+    try:
+        index = load_index()
+    except (IOError, ValueError, KeyError) as e:
+        log.error('Failed to load hosts conf, reason: %s', e)
+        print('Failed to load hosts conf: %s' % e)
+        return
+
+    if query == 'all':
+        results = [(1.0, entry) for entry in index.entries()]
+        sort_key = sort_key or 'alias'
+    else:
+        sort_key = sort_key or 'score'
+        results = index.search(query, limit if sort_key == 'score' else None)
+
+    if sort_key == 'score':
+        results.sort(key=lambda r: (-r[0], r[1]['alias']))
+    else:
+        results.sort(key=lambda r: r[1][sort_key])
+
+    fields = list(INFO_FIELDS)
+    if with_status:
+        forwarded_ports, forwarder_ports = get_live_status()
+        fields.append('status')
+    if query != 'all':
+        fields.append('score')
+
+    if output_format == 'tsv':
+        sys.stdout.write('\t'.join(fields) + '\n')
+
+    for score, entry in results[:limit]:
+        row = dict(entry, score=round(score, 3))
+        if with_status:
+            row['status'] = entry_status(entry, forwarded_ports, forwarder_ports)
+
+        if output_format == 'json':
+            sys.stdout.write(json.dumps({field: row[field] for field in fields}) + '\n')
+        elif output_format == 'tsv':
+            sys.stdout.write('\t'.join(str(row[field]) for field in fields) + '\n')
+        else:
+            line = '%-30s - %s:%s' % (row['alias'], row['host'], row['port'])
+            if with_status:
+                line = '%-60s %s' % (line, row['status'])
+            sys.stdout.write(line + '\n')
 
 
 def create_args_parser():
     parent_parser = argparse.ArgumentParser(prog='stm', description='SSH tunnel master', add_help=False)
+    parent_parser.add_argument('-log_level', choices=LOG_LEVELS)
     parser = argparse.ArgumentParser(add_help=False)
     subparsers = parser.add_subparsers(dest='operation')
     
@@ -31,10 +85,11 @@ def create_args_parser():
 
     # ssh
     ssh_handler_parser = subparsers.add_parser('ssh', parents=[parent_parser])
-    ssh_handler_parser.add_argument('-service', required=True)
+    ssh_handler_parser.add_argument('-service')
     ssh_handler_parser.add_argument('-alias', required=True)
     ssh_handler_parser.add_argument('-count', default=1, const=1, nargs='?', type=int)
     ssh_handler_parser.add_argument('-launch', default=1, type=int)
+    ssh_handler_parser.add_argument('-backend', choices=BACKENDS)
 
     # scp
     scp_handler_parser = subparsers.add_parser('scp', parents=[parent_parser])
@@ -43,9 +98,43 @@ def create_args_parser():
     scp_handler_parser.add_argument('-from_files', required=True)
     scp_handler_parser.add_argument('-to_files', required=True)
 
+    # sync
+    sync_handler_parser = subparsers.add_parser('sync', parents=[parent_parser])
+    sync_handler_parser.add_argument('-alias', required=True)
+    sync_handler_parser.add_argument('-direction', choices=('down', 'up',), required=True)
+    sync_handler_parser.add_argument('-from_files', required=True)
+    sync_handler_parser.add_argument('-to_files', required=True)
+
+    # tune
+    tune_handler_parser = subparsers.add_parser('tune', parents=[parent_parser])
+    tune_handler_parser.add_argument('-alias', required=True)
+    tune_handler_parser.add_argument('-size', default=16, type=int)
+    tune_handler_parser.add_argument('-rounds', default=2, type=int)
+
+    # restore
+    restore_handler_parser = subparsers.add_parser('restore', parents=[parent_parser])
+    restore_handler_parser.add_argument('-jobs', default=8, type=int)
+
+    # close
+    close_handler_parser = subparsers.add_parser('close', parents=[parent_parser])
+    close_handler_parser.add_argument('-alias', required=True)
+
+    # forward
+    forwarder_parser = subparsers.add_parser('forward', parents=[parent_parser])
+    forwarder_parser.add_argument('-parent_port', required=True, type=int)
+
+    # watch
+    subparsers.add_parser('watch', parents=[parent_parser])
+
     # info
     info_parser = subparsers.add_parser('info', parents=[parent_parser])
     info_parser.add_argument('-aliases', const='all', nargs='?')
+    info_parser.add_argument('-format', default='text', choices=('text', 'json', 'tsv',))
+    info_parser.add_argument('-sort', choices=('alias', 'host', 'port', 'score',))
+    info_parser.add_argument('-status', action='store_true')
+    info_parser.add_argument('-limit', type=int)
+    info_parser.add_argument('-forwards', action='store_true')
+    info_parser.add_argument('-services', action='store_true')
 
     args = parser.parse_args()
 
@@ -53,28 +142,45 @@ def create_args_parser():
 
 def main():
     res = create_args_parser()
+    setup_logging(getattr(res, 'log_level', None))
 
     if res.operation == 'agent':
         stm_agent = StmAgent()
         stm_agent.start_agent(res.type)
     elif res.operation == 'info':
         if res.aliases:
-            try:
-                with open(HOSTS_FILENAME, 'r') as f_obj:
-                    config = json.loads(f_obj.read())
-            except IOError as e:
-                log.error('Creating new conf file, reason: %s', e)
-            except ValueError as e:
-                log.error('Creating new conf, reason: %s', e)
-
-            for host_alias, conf in config['hosts'].items():
-                for username, alias in conf['users'].items():
-                    print('%-30s - %s:%s' % (alias, conf['host'], conf['port']))
+            print_aliases(res.aliases, res.format, res.sort, res.status, res.limit)
+        if res.forwards:
+            for alias, stats in sorted(load_forwarder_stats().items()):
+                print('%-30s - %-5s %s connections: %s, active: %s, in: %s B, out: %s B' % (
+                    alias, stats['mode'], stats['port'], stats['connections'], stats['active'],
+                    stats['bytes_in'], stats['bytes_out'],
+                ))
+        if res.services:
+            for alias, stats in sorted(load_service_stats().items()):
+                if not stats['count']:
+                    print('%-30s - never answered, failures: %s' % (alias, stats['failures']))
+                    continue
+                print('%-30s - last: %.1fms, avg: %.1fms, min: %.1fms, max: %.1fms, checks: %s, failures: %s' % (
+                    alias, stats['last'] * 1000, stats['avg'] * 1000, stats['min'] * 1000,
+                    stats['max'] * 1000, stats['count'], stats['failures'],
+                ))
     elif res.operation == 'ssh':
-        for i in range(res.count):
-            SshTunnelHandler(res.service, res.alias, res.launch)
+        SshTunnelHandler(res.service, res.alias, res.launch, res.count, res.backend)
+    elif res.operation == 'tune':
+        TuneHandler(res.alias, res.size, res.rounds)
+    elif res.operation == 'restore':
+        RestoreHandler(res.jobs)
+    elif res.operation == 'close':
+        CloseHandler(res.alias)
+    elif res.operation == 'forward':
+        Forwarder(res.parent_port).run()
+    elif res.operation == 'watch':
+        Watchdog().run()
     elif res.operation == 'scp':
         ScpHandler(res.alias, res.direction, res.from_files, res.to_files)
+    elif res.operation == 'sync':
+        SyncHandler(res.alias, res.direction, res.from_files, res.to_files)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import socket
+import struct
+import logging
+
+from config import SERVICE_STATS_FILENAME, READINESS_TIMEOUT
+from tunnel_lock import tunnel_lock
+
+log = logging.getLogger('stm')
+
+PSQL_SSL_REQUEST = struct.pack('!II', 8, 80877103)
+TCP_CLOSE_GRACE = 0.2
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by forward')
+        data += chunk
+
+    return data
+
+
+def probe_mysql(sock):
+    # the server speaks first with a protocol v10 handshake, an error packet
+    # (e.g. host not allowed) still proves the server was reached
+    length = struct.unpack('<I', _recv_exactly(sock, 4)[:3] + b'\x00')[0]
+    payload = _recv_exactly(sock, length)
+    return payload[:1] in (b'\x0a', b'\xff')
+
+
+def probe_psql(sock):
+    sock.sendall(PSQL_SSL_REQUEST)
+    return _recv_exactly(sock, 1) in (b'S', b'N')
+
+
+def probe_tcp(sock):
+    # a forward accepts locally even when the far end is down and then drops
+    # the connection, so an early close means not ready
+    sock.settimeout(TCP_CLOSE_GRACE)
+    try:
+        return sock.recv(1) != b''
+    except socket.timeout:
+        return True
+
+
+PROBES = {
+    'mysql': probe_mysql,
+    'psql': probe_psql,
+}
+
+
+def probe_service(service_type, port, timeout):
+    probe = PROBES.get(service_type, probe_tcp)
+    started = time.time()
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=timeout) as sock:
+            if not probe(sock):
+                return None
+    except (OSError, ConnectionError):
+        return None
+
+    return time.time() - started
+
+
+def wait_until_ready(service_type, port, timeout=READINESS_TIMEOUT):
+    deadline = time.time() + timeout
+    while True:
+        latency = probe_service(service_type, port, max(deadline - time.time(), 0.1))
+        if latency is not None or time.time() >= deadline:
+            return latency
+        time.sleep(0.2)
+
+
+def load_service_stats():
+    try:
+        with open(SERVICE_STATS_FILENAME, 'r') as f_obj:
+            return json.loads(f_obj.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def record_service_latency(alias, latency):
+    try:
+        with tunnel_lock('service_stats'):
+            stats = load_service_stats()
+            entry = stats.setdefault(alias, {
+                'count': 0, 'failures': 0, 'last': None, 'min': None, 'max': None, 'avg': None,
+            })
+            entry['checked'] = time.time()
+
+            if latency is None:
+                entry['failures'] += 1
+            else:
+                entry['last'] = latency
+                entry['min'] = latency if entry['min'] is None else min(entry['min'], latency)
+                entry['max'] = latency if entry['max'] is None else max(entry['max'], latency)
+                entry['avg'] = ((entry['avg'] or 0) * entry['count'] + latency) / (entry['count'] + 1)
+                entry['count'] += 1
+
+            tmp_filename = '%s.%s' % (SERVICE_STATS_FILENAME, os.getpid())
+            with open(tmp_filename, 'w') as f_obj:
+                f_obj.write(json.dumps(stats))
+            os.replace(tmp_filename, SERVICE_STATS_FILENAME)
+    except Exception as e:
+        log.exception('Failed to record latency for %s' % alias)
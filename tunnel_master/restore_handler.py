@@ -0,0 +1,120 @@
+import json
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from config import HOSTS_FILENAME
+from ssh_handler import SshTunnelHandler
+from forwarder import is_port_listening
+from bastion import is_main_tunnel_alive
+from session_store import load_sessions, forget_main_tunnel, forget_service_tunnel
+from log_setup import log_fields, setup_worker_logging
+
+log = logging.getLogger('stm')
+
+
+def _restore_tunnel(kind, alias):
+    # runs in a worker process, SshTunnelHandler keeps its state on the class
+    started = time.time()
+    try:
+        SshTunnelHandler(None, alias, 0)
+        if kind == 'main':
+            restored = is_main_tunnel_alive(SshTunnelHandler._parent_port)
+        else:
+            restored = is_port_listening(SshTunnelHandler._remote_port)
+    except Exception as e:
+        log.exception('Failed to restore %s tunnel %s' % (kind, alias))
+        restored = False
+
+    log.info('Restore of %s tunnel %s finished' % (kind, alias),
+             extra=log_fields(alias, 'restore_' + kind, 'restored' if restored else 'failed', started))
+
+    return kind, alias, restored, time.time() - started
+
+
+class RestoreHandler(object):
+    @classmethod
+    def __init__(cls, jobs):
+        cls._jobs = jobs
+        cls._results = []
+
+        if cls._load():
+            cls._restore()
+
+    @classmethod
+    def _load(cls):
+        try:
+            with open(HOSTS_FILENAME, 'r') as f_obj:
+                cls._config = json.loads(f_obj.read())
+        except IOError as e:
+            log.error('Hosts file is missing...')
+            return False
+        except Exception as e:
+            log.exception('Got unexpected exception @ loading conf')
+            return False
+
+        alias_ports = {}
+        for host_alias, conf in cls._config['hosts'].items():
+            for username, alias in conf['users'].items():
+                alias_ports[alias] = conf['port']
+
+        sessions = load_sessions()
+        cls._main_tunnels = {}
+        for parent_port, entry in sessions['main'].items():
+            if alias_ports.get(entry['alias']) != int(parent_port):
+                log.info('Dropping main tunnel %s from snapshot, alias is gone' % entry['alias'])
+                forget_main_tunnel(parent_port)
+                continue
+            cls._main_tunnels[int(parent_port)] = entry['alias']
+
+        # services depend on the main tunnel of the host they ride on
+        cls._service_tunnels = {}
+        services = cls._config.get('services', {})
+        for alias in sessions['services']:
+            if alias not in services or services[alias]['remote_tunnel'] not in alias_ports:
+                log.info('Dropping service tunnel %s from snapshot, alias is gone' % alias)
+                forget_service_tunnel(alias)
+                continue
+            cls._service_tunnels[alias] = alias_ports[services[alias]['remote_tunnel']]
+
+        return True
+
+    @classmethod
+    def _restore(cls):
+        started = time.time()
+
+        with ProcessPoolExecutor(max_workers=cls._jobs, initializer=setup_worker_logging) as executor:
+            main_jobs = {}
+            for parent_port, alias in cls._main_tunnels.items():
+                main_jobs[parent_port] = executor.submit(_restore_tunnel, 'main', alias)
+
+            failed_ports = set()
+            for parent_port, job in main_jobs.items():
+                result = job.result()
+                cls._results.append(result)
+                if not result[2]:
+                    failed_ports.add(parent_port)
+
+            service_jobs = []
+            for alias, parent_port in cls._service_tunnels.items():
+                if parent_port in failed_ports:
+                    cls._results.append(('service', alias, None, 0.0))
+                    continue
+                service_jobs.append(executor.submit(_restore_tunnel, 'service', alias))
+
+            for job in service_jobs:
+                cls._results.append(job.result())
+
+        statuses = {True: 'ok', False: 'failed', None: 'skipped'}
+        for kind, alias, restored, elapsed in cls._results:
+            print('%-30s %-8s %-8s %.2fs' % (alias, kind, statuses[restored], elapsed))
+
+        restored_count = len([r for r in cls._results if r[2]])
+        elapsed = time.time() - started
+        log.info('Restored %s of %s tunnels in %.2fs' % (restored_count, len(cls._results), elapsed))
+        print('Restored %s of %s tunnels in %.2fs' % (restored_count, len(cls._results), elapsed))
+        if restored_count < len(cls._results):
+            # failed tunnels stay in the snapshot, e.g. when the network is not back yet
+            print('Failed and skipped tunnels are kept, run stm restore again to retry them')
+
+        return restored_count == len(cls._results)
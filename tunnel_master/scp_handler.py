@@ -1,14 +1,12 @@
-import os
 import json
-import time
 import logging
 import subprocess
 import logging.handlers
-from dbus import SessionBus, Interface, String
 
-from config import HOSTS_FILENAME, YBER_TUNNEL
-
-KONSOLE_SESSION_PATH = 'org.kde.konsole.Session'
+from config import HOSTS_FILENAME
+from bastion import get_bastions, ensure_main_tunnel
+from session_store import record_main_tunnel
+from transport import get_transport, transport_cmd
 
 log = logging.getLogger('stm')
 
@@ -43,6 +41,8 @@ class ScpHandler(object):
                 reversed_users_conf = {v: k for k, v in conf['users'].items()}
                 cls._parent_host = conf['host']
                 cls._parent_port = conf['port']
+                cls._bastions = get_bastions(conf)
+                cls._transport = get_transport(conf)
                 cls._user = reversed_users_conf[cls._alias]
                 found = True
                 break       
@@ -51,39 +51,11 @@ class ScpHandler(object):
             log.error('Alias not found')
             return 
 
-        if not cls._is_main_tunnel_active():
-            status = cls._construct_main_tunnel()
-            if not status:
-                log.error('Failed to build parent tunnel for %s', (cls._alias))
-                return
-
-    @classmethod
-    def _is_main_tunnel_active(cls):
-        try:
-            tunnel_uri = '%s:%s' % (cls._parent_port, cls._parent_host)
-            subprocess.check_output(['pgrep', '-f', tunnel_uri])
-        except Exception as e:
-            #exception expected here, hence no logging        
-            return False
-
-        return True
-
-    @classmethod
-    def _construct_main_tunnel(cls):
-        main_ssh_tunnel_cmd = 'autossh -M 0 -f -N -L %s:%s:%s %s' % (
-            cls._parent_port, cls._parent_host, 22, YBER_TUNNEL)
-
-        try:
-            subprocess.call(main_ssh_tunnel_cmd, shell=True)
-            time.sleep(0.5)
-            log.info('Created main tunnel for %s [%s]' % 
-                    (cls._alias, main_ssh_tunnel_cmd))
-        except:
-            log.exception('Failed to build main tunnel for %s [%s]' % 
-                    (cls._alias, main_ssh_tunnel_cmd))
-            return False
+        if not ensure_main_tunnel(cls._alias, cls._parent_host, cls._parent_port, cls._bastions, cls._transport):
+            log.error('Failed to build parent tunnel for %s', (cls._alias))
+            return
 
-        return True
+        record_main_tunnel(cls._parent_port, cls._alias)
 
     @classmethod
     def _send_files(cls):
@@ -95,7 +67,7 @@ class ScpHandler(object):
             print('Unknown direction')
             return
 
-        scp_cmd = 'scp -P %s -r %s' % (cls._parent_port, files_uri)
+        scp_cmd = 'scp%s -P %s -r %s' % (transport_cmd(cls._transport), cls._parent_port, files_uri)
         try:
             subprocess.call(scp_cmd, shell=True)
         except:
@@ -0,0 +1,203 @@
+import os
+import time
+import logging
+import subprocess
+
+from config import LOG_DIR
+from log_setup import log_fields
+
+KONSOLE_SESSION_PATH = 'org.kde.konsole.Session'
+TMUX_SESSION_NAME = 'stm'
+BACKENDS = ('konsole', 'tmux', 'foreground', 'subprocess',)
+SUBPROCESS_LOG_FILENAME = os.path.join(LOG_DIR, 'sessions.log')
+
+log = logging.getLogger('stm')
+
+
+class KonsoleSessionLauncher(object):
+
+    def __init__(self, service, window_id):
+        self._service = service
+        self._window_id = window_id
+        self._bus = None
+        self._window = None
+        self._env = None
+
+    def launch(self, sessions):
+        # sessions is a list of (command, title) tuples, title may be None
+        if not self._window_id:
+            log.error('Missing window_id')
+            return 0
+
+        started = time.time()
+        self._connect()
+
+        # newSession is the only call we need an answer from, everything
+        # else is queued on the same connection without waiting for replies
+        session_ids = [self._window.newSession() for _ in sessions]
+
+        for session_id, (command, title) in zip(session_ids, sessions):
+            bus_intf = self._get_session(session_id)
+            bus_intf.setEnvironment(self._get_environment(bus_intf), ignore_reply=True)
+            bus_intf.runCommand(command, ignore_reply=True)
+            if title:
+                bus_intf.setTitle(1, title, ignore_reply=True)
+
+        elapsed = time.time() - started
+        log.info('Launched %s konsole session(s) in %.3fs (%.3fs per tab)' % (
+            len(session_ids), elapsed, elapsed / max(len(session_ids), 1)),
+            extra=log_fields(None, 'launch_sessions', 'launched', started)
+        )
+
+        return len(session_ids)
+
+    def _connect(self):
+        # dbus is only needed on desktops, keep headless backends free of it
+        from dbus import SessionBus
+
+        if self._bus is None:
+            self._bus = SessionBus()
+            self._window = self._bus.get_object(self._service, self._window_id)
+
+    def _get_session(self, session_id):
+        from dbus import Interface
+
+        sess = self._bus.get_object(self._service, '/Sessions/' + str(session_id))
+        return Interface(sess, KONSOLE_SESSION_PATH)
+
+    def _get_environment(self, bus_intf):
+        from dbus import String
+
+        # all sessions of a window share the profile environment, so it is
+        # fetched from the first session only
+        if self._env is None:
+            self._env = bus_intf.environment()
+            self._env.append(String('KONSOLE_DBUS_WINDOW=' + self._window_id))
+
+        return self._env
+
+
+class TmuxSessionLauncher(object):
+
+    def __init__(self, session_name=TMUX_SESSION_NAME):
+        self._session_name = session_name
+
+    def launch(self, sessions):
+        if not sessions:
+            return 0
+
+        started = time.time()
+        tmux_cmd = ['tmux']
+
+        # inside tmux the windows go to the current session, otherwise into a
+        # detached session which is created by the first command of the batch
+        if os.environ.get('TMUX'):
+            target = None
+        elif self._has_session():
+            target = self._session_name + ':'
+        else:
+            command, title = sessions[0]
+            tmux_cmd += ['new-session', '-d', '-s', self._session_name]
+            tmux_cmd += ['-n', title or command, command]
+            sessions = sessions[1:]
+            target = self._session_name + ':'
+
+        for command, title in sessions:
+            if len(tmux_cmd) > 1:
+                tmux_cmd.append(';')
+            tmux_cmd += ['new-window', '-d']
+            if target:
+                tmux_cmd += ['-t', target]
+            tmux_cmd += ['-n', title or command, command]
+
+        subprocess.check_call(tmux_cmd)
+        if target:
+            print('Sessions started in tmux, attach with: tmux attach -t %s' % self._session_name)
+
+        elapsed = time.time() - started
+        launched = tmux_cmd.count('new-window') + tmux_cmd.count('new-session')
+        log.info('Launched %s tmux window(s) in %.3fs (%.3fs per window)' % (
+            launched, elapsed, elapsed / launched),
+            extra=log_fields(None, 'launch_sessions', 'launched', started)
+        )
+
+        return launched
+
+    def _has_session(self):
+        status = subprocess.call(
+            ['tmux', 'has-session', '-t', self._session_name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        return status == 0
+
+
+class ForegroundSessionLauncher(object):
+
+    def launch(self, sessions):
+        # without a terminal multiplexer the sessions take over the current
+        # terminal, one after another
+        launched = 0
+
+        for command, title in sessions:
+            started = time.time()
+            status = subprocess.call(command, shell=True)
+            log.info('Foreground session [%s] exited with %s after %.3fs' % (
+                command, status, time.time() - started),
+                extra=log_fields(None, 'launch_sessions', 'exited', started)
+            )
+            launched += 1
+
+        return launched
+
+
+class SubprocessSessionLauncher(object):
+    # detached processes have no terminal, so this backend only suits
+    # non-interactive commands and testing, output goes to sessions.log
+
+    def launch(self, sessions):
+        started = time.time()
+        pids = []
+
+        with open(SUBPROCESS_LOG_FILENAME, 'a') as f_obj:
+            for command, title in sessions:
+                proc = subprocess.Popen(
+                    command, shell=True, start_new_session=True,
+                    stdin=subprocess.DEVNULL, stdout=f_obj, stderr=subprocess.STDOUT,
+                )
+                pids.append(proc.pid)
+
+        elapsed = time.time() - started
+        log.info('Launched %s detached process(es) %s in %.3fs, output in %s' % (
+            len(pids), pids, elapsed, SUBPROCESS_LOG_FILENAME),
+            extra=log_fields(None, 'launch_sessions', 'launched', started)
+        )
+
+        return len(pids)
+
+
+def detect_backend():
+    if os.environ.get('KONSOLE_DBUS_WINDOW'):
+        return 'konsole'
+    elif os.environ.get('TMUX'):
+        # outside tmux the windows would land in a detached session the user
+        # never sees, so the current terminal is used instead
+        return 'tmux'
+
+    return 'foreground'
+
+
+def get_launcher(backend=None, service=None):
+    if not backend:
+        backend = detect_backend()
+
+    if backend == 'konsole':
+        service = service or os.environ.get('KONSOLE_DBUS_SERVICE')
+        return KonsoleSessionLauncher(service, os.environ.get('KONSOLE_DBUS_WINDOW'))
+    elif backend == 'tmux':
+        return TmuxSessionLauncher()
+    elif backend == 'foreground':
+        return ForegroundSessionLauncher()
+    elif backend == 'subprocess':
+        return SubprocessSessionLauncher()
+
+    raise ValueError('Unknown terminal backend: %s' % backend)
@@ -0,0 +1,62 @@
+import os
+import json
+import time
+import logging
+
+from config import SESSIONS_FILENAME
+from tunnel_lock import tunnel_lock
+
+log = logging.getLogger('stm')
+
+
+def load_sessions():
+    try:
+        with open(SESSIONS_FILENAME, 'r') as f_obj:
+            sessions = json.loads(f_obj.read())
+    except (IOError, ValueError):
+        sessions = {}
+
+    sessions.setdefault('main', {})
+    sessions.setdefault('services', {})
+    return sessions
+
+
+def _write_sessions(sessions):
+    tmp_filename = '%s.%s' % (SESSIONS_FILENAME, os.getpid())
+    with open(tmp_filename, 'w') as f_obj:
+        f_obj.write(json.dumps(sessions))
+    os.replace(tmp_filename, SESSIONS_FILENAME)
+
+
+def _update_sessions(kind, key, entry):
+    try:
+        with tunnel_lock('sessions'):
+            sessions = load_sessions()
+            if entry is None:
+                sessions[kind].pop(key, None)
+            else:
+                sessions[kind][key] = entry
+            _write_sessions(sessions)
+    except Exception as e:
+        # the snapshot is best effort and must never break a launch
+        log.exception('Failed to update session snapshot')
+
+
+def record_main_tunnel(parent_port, alias):
+    # main tunnels are keyed by parent port, the alias is any user of the host
+    _update_sessions('main', str(parent_port), {'alias': alias, 'created': time.time()})
+
+
+def record_service_tunnel(alias, port, parent_port, forward_mode):
+    _update_sessions('services', alias, {
+        'port': port, 'parent_port': parent_port, 'forward_mode': forward_mode,
+        'created': time.time(),
+    })
+
+
+def forget_main_tunnel(parent_port):
+    _update_sessions('main', str(parent_port), None)
+
+
+def forget_service_tunnel(alias):
+    _update_sessions('services', alias, None)
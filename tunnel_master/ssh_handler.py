@@ -1,25 +1,33 @@
-import os
 import json
 import time
 import logging
 import subprocess
 import logging.handlers
-from dbus import SessionBus, Interface, String
 
-from config import HOSTS_FILENAME, YBER_TUNNEL
-
-KONSOLE_SESSION_PATH = 'org.kde.konsole.Session'
+from config import HOSTS_FILENAME, FORWARDER_TIMEOUT
+from bastion import get_bastions, ensure_main_tunnel
+from transport import get_transport, transport_args, transport_cmd
+from tunnel_lock import tunnel_lock
+from session_store import record_main_tunnel, record_service_tunnel
+from readiness import wait_until_ready, record_service_latency
+from log_setup import log_fields
+from session_launcher import get_launcher
+from forwarder import (
+    FORWARDER_MODES, get_socks_port, is_port_listening, wait_for_port, ensure_forwarder,
+    construct_mux_master,
+)
 
 log = logging.getLogger('stm')
 
 
 class SshTunnelHandler(object):
     @classmethod
-    def __init__(cls, service, alias, launch):
-        cls._window_id = os.environ['KONSOLE_DBUS_WINDOW']
+    def __init__(cls, service, alias, launch, count=1, backend=None):
         cls._service = service
         cls._alias = alias
         cls._launch = launch
+        cls._count = count
+        cls._launcher = get_launcher(backend, service)
         cls._parent_host = None
         cls._parent_port = None
         cls._user = None
@@ -27,6 +35,7 @@ class SshTunnelHandler(object):
         cls._sql_password = None
         cls._sql_database = None
         cls._tunnel_type = 'ssh'
+        cls._forward_mode = 'autossh'
 
         cls.launch()
 
@@ -57,6 +66,7 @@ class SshTunnelHandler(object):
                 cls._sql_username = conf['sql_username']
                 cls._sql_password = conf['sql_password']
                 cls._sql_database = conf['sql_database']
+                cls._forward_mode = conf.get('forward_mode', 'autossh')
                 break
 
         for host_alias, conf in cls._config['hosts'].items():
@@ -64,6 +74,9 @@ class SshTunnelHandler(object):
                 reversed_users_conf = {v: k for k, v in conf['users'].items()}
                 cls._parent_host = conf['host']
                 cls._parent_port = conf['port']
+                cls._bastions = get_bastions(conf)
+                cls._transport = get_transport(conf)
+                cls._socks_port = get_socks_port(conf)
                 cls._user = reversed_users_conf[remote_tunnel_alias]
                 found = True
                 break       
@@ -72,73 +85,46 @@ class SshTunnelHandler(object):
             log.error('Alias not found')
             return 
 
-        if not cls._is_main_tunnel_active():
-            status = cls._construct_main_tunnel()
-            if not status:
-                log.error('Failed to build parent tunnel for %s', (cls._alias))
-                return
+        if not ensure_main_tunnel(cls._alias, cls._parent_host, cls._parent_port, cls._bastions, cls._transport):
+            log.error('Failed to build parent tunnel for %s', (cls._alias))
+            return
+
+        record_main_tunnel(cls._parent_port, remote_tunnel_alias)
 
         if cls._launch and cls._tunnel_type == 'ssh':
             cls._construct_sub_tunnel()
-        elif cls._launch and cls._tunnel_type == 'service':
-            cls._construct_service_tunnel()
-            if cls._launch == 1:
-                cls._launch_service_client()
-        elif not cls._launch and cls._tunnel_type == 'service':
-            cls._construct_service_tunnel()
-
-    @classmethod
-    def _is_main_tunnel_active(cls):
-        try:
-            tunnel_uri = '%s:%s' % (cls._parent_port, cls._parent_host)
-            subprocess.check_output(['pgrep', '-f', tunnel_uri])
-        except Exception as e:
-            #exception expected here, hence no logging        
-            return False
-
-        return True
-
-    @classmethod
-    def _construct_main_tunnel(cls):
-        main_ssh_tunnel_cmd = 'autossh -M 0 -f -N -L %s:%s:%s %s' % (
-            cls._parent_port, cls._parent_host, 22, YBER_TUNNEL)
-
-        try:
-            subprocess.call(main_ssh_tunnel_cmd, shell=True)
-            time.sleep(0.5)
-            log.info('Created main tunnel for %s [%s]' % 
-                    (cls._alias, main_ssh_tunnel_cmd))
-        except:
-            log.exception('Failed to build main tunnel for %s [%s]' % 
-                    (cls._alias, main_ssh_tunnel_cmd))
-            return False
+        elif cls._tunnel_type == 'service':
+            if not cls._construct_service_tunnel():
+                return
 
-        return True
+            record_service_tunnel(cls._alias, cls._remote_port, cls._parent_port, cls._forward_mode)
+            if cls._launch == 1 and cls._is_service_ready():
+                cls._launch_service_client()
 
     @classmethod
     def _construct_sub_tunnel(cls):
-        if not cls._window_id:
-            log.error('Missing window_id')
-            return False
+        destination = '%s@localhost' % cls._user
+        sub_tunnel_cmd = 'ssh%s %s -p %s' % (transport_cmd(cls._transport), destination, cls._parent_port)
 
         try:
-            session_bus = SessionBus()
-            new_session = session_bus.get_object(cls._service, cls._window_id).newSession()
-            sess = session_bus.get_object(cls._service, '/Sessions/' + str(new_session))
-            bus_intf = Interface(sess, KONSOLE_SESSION_PATH)
-            env = bus_intf.environment()
-            env.append(String('KONSOLE_DBUS_WINDOW=' + cls._window_id))
-            bus_intf.setEnvironment(env)
-            destination = '%s@localhost' % cls._user
-            bus_intf.runCommand('ssh ' + destination + ' -p ' + str(cls._parent_port))
+            launched = cls._launcher.launch([(sub_tunnel_cmd, None)] * cls._count)
         except:
             log.exception('Failed to build tunnel for %s' % (cls._alias))
             return False
 
-        return True
+        return bool(launched)
 
     @classmethod
     def _construct_service_tunnel(cls):
+        if cls._forward_mode in FORWARDER_MODES:
+            with tunnel_lock('forwarder_%s' % cls._parent_port):
+                return cls._construct_forwarded_service()
+
+        with tunnel_lock('service_%s' % cls._remote_port):
+            return cls._construct_autossh_service_tunnel()
+
+    @classmethod
+    def _construct_autossh_service_tunnel(cls):
         try:
             service_uri = '%s:%s' % (cls._remote_port, cls._service_host)
             subprocess.check_output(['pgrep', '-f', service_uri])
@@ -147,60 +133,101 @@ class SshTunnelHandler(object):
             #exception expected here, hence no logging just continue
             pass
 
-
-        service_tunnel_cmd = 'autossh -M 0 -f -N -L %s:%s:%s %s@localhost -p %s' % (
-            cls._remote_port, cls._service_host, cls._service_port, cls._user, cls._parent_port,
+        service_tunnel_cmd = 'autossh -M 0 -f -N%s -L %s:%s:%s %s@localhost -p %s' % (
+            transport_cmd(cls._transport), cls._remote_port, cls._service_host, cls._service_port,
+            cls._user, cls._parent_port,
         )
 
+        started = time.time()
         try:
             subprocess.call(service_tunnel_cmd, shell=True)
             time.sleep(1)
             log.info('Created service tunnel for %s [%s]' % (
-                cls._alias, service_tunnel_cmd)
+                cls._alias, service_tunnel_cmd), extra=log_fields(cls._alias, 'service_tunnel', 'created', started)
             )
         except:
             log.exception('Failed to build service tunnel for %s [%s]' % (
-                cls._alias, service_tunnel_cmd)
+                cls._alias, service_tunnel_cmd), extra=log_fields(cls._alias, 'service_tunnel', 'error', started)
             )
             return False
 
         return True
 
     @classmethod
-    def _launch_service_client(cls):
-        if not cls._window_id:
-            log.error('Missing window_id')
-            return False
+    def _construct_socks_tunnel(cls):
+        if is_port_listening(cls._socks_port):
+            return True
+
+        socks_tunnel_cmd = 'autossh -M 0 -f -N%s -D 127.0.0.1:%s %s@localhost -p %s' % (
+            transport_cmd(cls._transport), cls._socks_port, cls._user, cls._parent_port,
+        )
 
+        started = time.time()
         try:
-            session_bus = SessionBus()
-            new_session = session_bus.get_object(cls._service, cls._window_id).newSession()
-            sess = session_bus.get_object(cls._service, '/Sessions/' + str(new_session))
-            bus_intf = Interface(sess, KONSOLE_SESSION_PATH)
-            env = bus_intf.environment()
-            env.append(String('KONSOLE_DBUS_WINDOW=' + cls._window_id))
-            bus_intf.setEnvironment(env)
-            destination = '%s@localhost' % cls._user
-            tab_name = None
-
-            if cls._service_type == 'mysql':
-                service_client_cmd = 'mysql -h 127.0.0.1 -P %s -u %s -p%s %s' % (
-                    cls._remote_port, cls._sql_username, cls._sql_password, cls._sql_database,
-                )
-                tab_name = 'MySQL :: ' + cls._alias
-            elif cls._service_type == 'psql':
-                service_client_cmd = 'psql -h 127.0.0.1 -p %s -U %s %s' % (
-                    cls._remote_port, cls._sql_username, cls._sql_database,
-                )
-                tab_name = 'PSQL :: ' + cls._alias
-            else:
-                print('Service type unknown')
-                return
+            subprocess.call(socks_tunnel_cmd, shell=True)
+            log.info('Created socks tunnel for %s [%s]' % (cls._alias, socks_tunnel_cmd),
+                     extra=log_fields(cls._alias, 'socks_tunnel', 'created', started))
+        except:
+            log.exception('Failed to build socks tunnel for %s [%s]' % (
+                cls._alias, socks_tunnel_cmd), extra=log_fields(cls._alias, 'socks_tunnel', 'error', started)
+            )
+            return False
+
+        return wait_for_port(cls._socks_port, FORWARDER_TIMEOUT)
+
+    @classmethod
+    def _construct_forwarded_service(cls):
+        # one dynamic forward or mux master per parent tunnel serves every
+        # service of the host, the local forwarder publishes it on the service port
+        if cls._forward_mode == 'socks' and not cls._construct_socks_tunnel():
+            log.error('Socks tunnel for %s is not listening on %s' % (cls._alias, cls._socks_port))
+            return False
+        elif cls._forward_mode == 'mux' and not construct_mux_master(
+                cls._user, cls._parent_port, transport_args(cls._transport)):
+            log.error('Mux master for %s is not running' % (cls._alias))
+            return False
+
+        if not ensure_forwarder(cls._parent_port, cls._remote_port):
+            log.error('Forwarder for %s is not listening on %s' % (cls._alias, cls._remote_port))
+            return False
 
-            bus_intf.runCommand(service_client_cmd)
-            bus_intf.setTitle(1, tab_name)
+        return True
+
+    @classmethod
+    def _is_service_ready(cls):
+        latency = wait_until_ready(cls._service_type, cls._remote_port)
+        record_service_latency(cls._alias, latency)
+
+        if latency is None:
+            log.error('Service %s is not answering on %s' % (cls._alias, cls._remote_port),
+                      extra=log_fields(cls._alias, 'readiness', 'timeout'))
+            print('Service %s is not answering on %s' % (cls._alias, cls._remote_port))
+            return False
+
+        log.info('Service %s answered on %s in %.3fs' % (cls._alias, cls._remote_port, latency),
+                 extra=dict(log_fields(cls._alias, 'readiness', 'ready'), duration=latency))
+        return True
+
+    @classmethod
+    def _launch_service_client(cls):
+        if cls._service_type == 'mysql':
+            service_client_cmd = 'mysql -h 127.0.0.1 -P %s -u %s -p%s %s' % (
+                cls._remote_port, cls._sql_username, cls._sql_password, cls._sql_database,
+            )
+            tab_name = 'MySQL :: ' + cls._alias
+        elif cls._service_type == 'psql':
+            service_client_cmd = 'psql -h 127.0.0.1 -p %s -U %s %s' % (
+                cls._remote_port, cls._sql_username, cls._sql_database,
+            )
+            tab_name = 'PSQL :: ' + cls._alias
+        else:
+            print('Service type unknown')
+            return
+
+        try:
+            launched = cls._launcher.launch([(service_client_cmd, tab_name)] * cls._count)
         except:
             log.exception('Failed to build tunnel for %s' % (cls._alias))
             return False
 
-        return True       
+        return bool(launched)
@@ -9,7 +9,8 @@ import subprocess
 import logging.handlers
 from string import ascii_lowercase as ascii
 
-from config import APP_DIR, LOG_FILENAME, HOSTS_FILENAME, SSH_FILENAME, ALIASES_FILENAME, SSH_TUNNEL_MASTER_ALIASES
+from config import APP_DIR, LOG_FILENAME, HOSTS_FILENAME, SSH_FILENAME, ALIASES_FILENAME, SSH_TUNNEL_MASTER_ALIASES, YBER_TUNNEL
+from forwarder import FORWARD_MODES, get_socks_port
 
 log = logging.getLogger('stm')
 
@@ -35,6 +36,7 @@ class StmAgent(object):
         self._stm_type = None
         self._last_auto_port = 10000
         self._parent_tunnel_alias = None
+        self._bastions = [YBER_TUNNEL]
 
         self._load_config()
 
@@ -51,6 +53,10 @@ class StmAgent(object):
             if not self._prompt_user():
                 log.error('User info missing, aborting...')
                 return
+
+            if self._parent_tunnel_alias not in self._config['hosts']:
+                if not self._prompt_bastions():
+                    return
         elif stm_type == 'service':
             if not self._prompt_remote_tunnel_alias_input():
                 return
@@ -80,6 +86,9 @@ class StmAgent(object):
                 log.error('SQL DB name missing, aborting...')
                 return False
 
+            if not self._prompt_forward_mode():
+                return False
+
             self._services[self._alias] = {
                 'port': self._port,
                 'remote_tunnel': self._remote_tunnel,
@@ -89,6 +98,7 @@ class StmAgent(object):
                 'sql_username': self._sql_service_username,
                 'sql_password': self._sql_service_password,
                 'sql_database': self._sql_service_database,
+                'forward_mode': self._forward_mode,
             }
 
         else:
@@ -112,6 +122,8 @@ class StmAgent(object):
         for host_alias, conf in self._config['hosts'].items():
             self._hosts[host_alias] = conf['host']
             self._ports.add(conf['port'])
+            # the dynamic forward of socks mode services listens next to it
+            self._ports.add(get_socks_port(conf))
             self._users[host_alias] = conf['users']
             for username, alias in conf['users'].items():
                 self._aliases[alias] = {
@@ -119,7 +131,7 @@ class StmAgent(object):
                     'port': conf['port'],
                 }
 
-        for service_alias, conf in self._config['hosts'].items():
+        for service_alias, conf in self._config.get('services', {}).items():
             self._ports.add(conf['port'])
 
         self._services = self._config.get('services', {})
@@ -140,6 +152,7 @@ class StmAgent(object):
                     'host': self._parent_tunnel,
                     'port': self._port,
                     'users': self._users[self._parent_tunnel_alias],
+                    'bastions': self._bastions,
                 }
         elif self._stm_type == 'service':
             self._config['services'] = self._services
@@ -153,7 +166,7 @@ class StmAgent(object):
             except Exception as err:
                 f_obj.write('#/bin/bash\n\n')
 
-            f_obj.write('alias %s="stm ssh -s $KONSOLE_DBUS_SERVICE -a %s -c $1"\n' % (self._alias, self._alias,))
+            f_obj.write('alias %s="stm ssh -a %s -c $1"\n' % (self._alias, self._alias,))
 
     def _prompt_parent_input(self):
         try:
@@ -231,7 +244,7 @@ class StmAgent(object):
 
         if not port_input:
             while 1:
-                if self._last_auto_port in self._ports:
+                if self._is_port_taken(self._last_auto_port):
                     self._last_auto_port += 5
                     continue
 
@@ -251,7 +264,7 @@ class StmAgent(object):
                 print('Only integers are allowed')
                 return self._prompt_port()
 
-            if self._port in self._ports:
+            if self._is_port_taken(self._port):
                 print('Port already assigned, choose different one!')
                 return self._prompt_port()
 
@@ -260,6 +273,13 @@ class StmAgent(object):
 
             return True
 
+    def _is_port_taken(self, port):
+        if port in self._ports:
+            return True
+
+        # a new host also claims the port of its dynamic forward
+        return self._stm_type == 'client' and get_socks_port({'port': port}) in self._ports
+
     def _list_ports(self):
         if self._parent_tunnel_alias in self._config['hosts']:
             print('Assign port for given host', self._config['hosts'][self._parent_tunnel_alias]['port'])
@@ -327,6 +347,23 @@ class StmAgent(object):
         self._users[self._parent_tunnel_alias] = users
         return True
 
+    def _prompt_bastions(self):
+        try:
+            bastions_input = input('Enter bastions, comma separated user@host[:port] [%s]: ' % YBER_TUNNEL)
+        except KeyboardInterrupt:
+            print()
+            return False
+
+        if bastions_input:
+            bastions = [b.strip() for b in bastions_input.split(',') if b.strip()]
+            if not all('@' in b for b in bastions):
+                print('Bastions must be given as user@host[:port]!')
+                return self._prompt_bastions()
+
+            self._bastions = bastions
+
+        return True
+
     def _prompt_alias(self):
         try:
             alias_input = input('Enter alias for bash usage: ')
@@ -521,4 +558,19 @@ class StmAgent(object):
 
         return True
 
+    def _prompt_forward_mode(self):
+        try:
+            forward_mode_input = input('Enter forward mode %s [%s]: ' % (FORWARD_MODES, FORWARD_MODES[0]))
+        except KeyboardInterrupt:
+            print()
+            return False
 
+        if not forward_mode_input:
+            self._forward_mode = FORWARD_MODES[0]
+        elif forward_mode_input not in FORWARD_MODES:
+            print('Unknown forward mode!')
+            return self._prompt_forward_mode()
+        else:
+            self._forward_mode = forward_mode_input
+
+        return True
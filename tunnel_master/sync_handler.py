@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import shlex
+import hashlib
+import inspect
+import logging
+import subprocess
+
+import delta_sync
+from config import HOSTS_FILENAME, MANIFESTS_DIR
+from bastion import get_bastions, ensure_main_tunnel
+from session_store import record_main_tunnel
+from transport import get_transport, transport_args
+from delta_sync import LocalEndpoint, read_frame, write_frame, sync_tree
+from log_setup import log_fields
+
+log = logging.getLogger('stm')
+
+
+class RemoteEndpoint(object):
+
+    def __init__(self, ssh_cmd):
+        # ships delta_sync to the remote end and talks to it over ssh stdio
+        remote_cmd = 'python3 -c %s serve' % shlex.quote(inspect.getsource(delta_sync))
+        self._proc = subprocess.Popen(ssh_cmd + [remote_cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _send(self, header, payload=b''):
+        write_frame(self._proc.stdin, header, payload)
+
+    def _receive(self):
+        header, payload = read_frame(self._proc.stdout)
+        if 'error' in header:
+            raise RuntimeError('Remote sync failed: %s' % header['error'])
+        return header, payload
+
+    def _request(self, header):
+        self._send(header)
+        self._proc.stdin.flush()
+        return self._receive()[0]
+
+    def manifest(self, root):
+        return self._request({'op': 'manifest', 'root': root})['files']
+
+    def signature(self, root, rel, block_size):
+        return self._request({'op': 'signature', 'root': root, 'rel': rel, 'block_size': block_size})['signature']
+
+    def delta(self, root, rel, block_size, signature):
+        self._send({'op': 'delta', 'root': root, 'rel': rel, 'block_size': block_size, 'signature': signature})
+        self._proc.stdin.flush()
+
+        while True:
+            header, payload = self._receive()
+            yield header, payload
+            if header.get('done'):
+                break
+
+    def patch(self, root, rel, block_size, mtime, mode, frames):
+        self._send({
+            'op': 'patch', 'root': root, 'rel': rel, 'block_size': block_size,
+            'mtime': mtime, 'mode': mode,
+        })
+        for header, payload in frames:
+            self._send(header, payload)
+        self._proc.stdin.flush()
+        self._receive()
+
+    def close(self, abort=False):
+        # after a failure the remote end may still be streaming frames that
+        # are never read, so it is killed instead of being asked to quit
+        if not abort:
+            try:
+                self._send({'op': 'quit'})
+                self._proc.stdin.close()
+            except OSError:
+                abort = True
+
+        if abort:
+            self._proc.kill()
+        self._proc.wait()
+
+
+class SyncHandler(object):
+    @classmethod
+    def __init__(cls, alias, direction, files_from, files_to):
+        cls._alias = alias
+        cls._direction = direction
+        cls._files_from = files_from
+        cls._files_to = files_to
+
+        if cls._start_syncing():
+            cls._sync_files()
+
+    @classmethod
+    def _start_syncing(cls):
+        found = False
+
+        try:
+            with open(HOSTS_FILENAME, 'r') as f_obj:
+                cls._config = json.loads(f_obj.read())
+        except IOError as e:
+            log.error('Hosts file is missing...')
+            return False
+        except Exception as e:
+            log.exception('Got unexpected exception @ loading conf')
+            return False
+
+        for host_alias, conf in cls._config['hosts'].items():
+            if cls._alias in conf['users'].values():
+                reversed_users_conf = {v: k for k, v in conf['users'].items()}
+                cls._parent_host = conf['host']
+                cls._parent_port = conf['port']
+                cls._bastions = get_bastions(conf)
+                cls._transport = get_transport(conf)
+                cls._user = reversed_users_conf[cls._alias]
+                found = True
+                break
+
+        if not found:
+            log.error('Alias not found')
+            return False
+
+        if not ensure_main_tunnel(cls._alias, cls._parent_host, cls._parent_port, cls._bastions, cls._transport):
+            log.error('Failed to build parent tunnel for %s', (cls._alias))
+            return False
+
+        record_main_tunnel(cls._parent_port, cls._alias)
+
+        return True
+
+    @classmethod
+    def _sync_files(cls):
+        if cls._direction == 'down':
+            local_root = cls._files_from
+        elif cls._direction == 'up':
+            local_root = cls._files_to
+        else:
+            print('Unknown direction')
+            return False
+
+        # signatures of local files are cached per local root, so unchanged
+        # files are never read twice
+        root_key = hashlib.sha1(os.path.abspath(os.path.expanduser(local_root)).encode()).hexdigest()
+        manifest_filename = os.path.join(MANIFESTS_DIR, root_key + '.json')
+        try:
+            with open(manifest_filename, 'r') as f_obj:
+                cache = json.loads(f_obj.read())
+        except (IOError, ValueError):
+            cache = {}
+
+        started = time.time()
+        local = LocalEndpoint(cache)
+        remote = RemoteEndpoint(
+            ['ssh'] + transport_args(cls._transport) + ['-p', str(cls._parent_port), '%s@localhost' % cls._user])
+
+        failed = True
+        try:
+            if cls._direction == 'down':
+                stats = sync_tree(local, cls._files_from, remote, cls._files_to)
+            else:
+                stats = sync_tree(remote, cls._files_from, local, cls._files_to)
+            failed = False
+        except Exception as e:
+            log.exception('Failed to sync files with %s [%s -> %s]' % (
+                cls._alias, cls._files_from, cls._files_to), extra=log_fields(cls._alias, 'sync', 'error', started)
+            )
+            print('Sync failed: %s' % e)
+            return False
+        finally:
+            remote.close(abort=failed)
+            with open(manifest_filename, 'w') as f_obj:
+                f_obj.write(json.dumps(cache))
+
+        stats['elapsed'] = time.time() - started
+        log.info('Synced %s [%s -> %s]: %s' % (cls._alias, cls._files_from, cls._files_to, stats),
+                 extra=log_fields(cls._alias, 'sync', 'synced', started))
+        print('%(files)s files, %(transferred)s transferred, %(skipped)s unchanged, '
+              '%(literal_bytes)s bytes sent, %(matched_bytes)s bytes matched in %(elapsed).2fs' % stats)
+
+        return True
@@ -0,0 +1,53 @@
+import shlex
+import subprocess
+
+# profile keys stored per host in hosts.conf and the ssh options they map to
+TRANSPORT_OPTIONS = {
+    'cipher': 'Ciphers',
+    'compression': 'Compression',
+    'keepalive': 'ServerAliveInterval',
+    'keepalive_count': 'ServerAliveCountMax',
+    'tcp_keepalive': 'TCPKeepAlive',
+    'ipqos': 'IPQoS',
+}
+CANDIDATE_CIPHERS = (
+    'aes128-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com',
+    'aes256-gcm@openssh.com',
+    'aes128-ctr',
+)
+CANDIDATE_COMPRESSIONS = ('no', 'yes',)
+# stm tune only measures the inner hop through the parent tunnel, these are
+# never applied to the bastion hop which may not support the tuned cipher
+TUNED_OPTIONS = ('cipher', 'compression',)
+
+
+def get_transport(host_conf):
+    return host_conf.get('transport', {})
+
+
+def bastion_transport(transport):
+    return {key: value for key, value in transport.items() if key not in TUNED_OPTIONS}
+
+
+def transport_args(transport):
+    args = []
+    for key, value in sorted(transport.items()):
+        if key in TRANSPORT_OPTIONS:
+            args += ['-o', '%s=%s' % (TRANSPORT_OPTIONS[key], value)]
+
+    return args
+
+
+def transport_cmd(transport):
+    # for shell command strings, every option comes with a leading space
+    return ''.join(' ' + shlex.quote(arg) for arg in transport_args(transport))
+
+
+def supported_ciphers():
+    try:
+        output = subprocess.check_output(['ssh', '-Q', 'cipher']).decode()
+    except Exception as e:
+        return set(CANDIDATE_CIPHERS)
+
+    return set(output.split())
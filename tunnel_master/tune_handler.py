@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+import subprocess
+
+from config import HOSTS_FILENAME
+from bastion import get_bastions, ensure_main_tunnel
+from session_store import record_main_tunnel
+from transport import (
+    CANDIDATE_CIPHERS, CANDIDATE_COMPRESSIONS, get_transport, transport_args, supported_ciphers,
+)
+
+log = logging.getLogger('stm')
+
+TUNE_TIMEOUT = 120
+SAMPLE_LINE = b'2024-01-01 12:00:00,000 - app - INFO - request handled in 12ms status=200 path=/api/v1/items\n'
+
+
+class TuneHandler(object):
+    @classmethod
+    def __init__(cls, alias, size, rounds):
+        cls._alias = alias
+        cls._size = size * 1024 * 1024
+        cls._rounds = rounds
+
+        if cls._start_tuning():
+            cls._tune()
+
+    @classmethod
+    def _start_tuning(cls):
+        found = False
+
+        try:
+            with open(HOSTS_FILENAME, 'r') as f_obj:
+                cls._config = json.loads(f_obj.read())
+        except IOError as e:
+            log.error('Hosts file is missing...')
+            return False
+        except Exception as e:
+            log.exception('Got unexpected exception @ loading conf')
+            return False
+
+        for host_alias, conf in cls._config['hosts'].items():
+            if cls._alias in conf['users'].values():
+                reversed_users_conf = {v: k for k, v in conf['users'].items()}
+                cls._host_alias = host_alias
+                cls._parent_host = conf['host']
+                cls._parent_port = conf['port']
+                cls._bastions = get_bastions(conf)
+                cls._transport = get_transport(conf)
+                cls._user = reversed_users_conf[cls._alias]
+                found = True
+                break
+
+        if not found:
+            log.error('Alias not found')
+            return False
+
+        if not ensure_main_tunnel(cls._alias, cls._parent_host, cls._parent_port, cls._bastions, cls._transport):
+            log.error('Failed to build parent tunnel for %s', (cls._alias))
+            return False
+
+        record_main_tunnel(cls._parent_port, cls._alias)
+
+        return True
+
+    @classmethod
+    def _benchmark(cls, transport, payload):
+        tune_cmd = ['ssh', '-o', 'BatchMode=yes'] + transport_args(transport)
+        tune_cmd += ['-p', str(cls._parent_port), '%s@localhost' % cls._user, 'cat > /dev/null']
+
+        best = None
+        for _ in range(cls._rounds):
+            started = time.time()
+            try:
+                proc = subprocess.run(
+                    tune_cmd, input=payload, timeout=TUNE_TIMEOUT,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                )
+            except subprocess.TimeoutExpired:
+                return None
+
+            if proc.returncode != 0:
+                return None
+
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        return best
+
+    @classmethod
+    def _tune(cls):
+        # half incompressible, half log-like data so compression is judged fairly
+        payload = os.urandom(cls._size // 2)
+        payload += SAMPLE_LINE * ((cls._size - len(payload)) // len(SAMPLE_LINE))
+
+        available = supported_ciphers()
+        ciphers = [c for c in CANDIDATE_CIPHERS if c in available]
+        results = []
+        for cipher in ciphers:
+            for compression in CANDIDATE_COMPRESSIONS:
+                transport = dict(cls._transport, cipher=cipher, compression=compression)
+                elapsed = cls._benchmark(transport, payload)
+                if elapsed is None:
+                    print('%-32s compression: %-3s - failed' % (cipher, compression))
+                    continue
+
+                print('%-32s compression: %-3s - %.2fs, %.1f MB/s' % (
+                    cipher, compression, elapsed, len(payload) / elapsed / 1024 / 1024))
+                results.append((elapsed, transport))
+
+        if not results:
+            log.error('No transport profile worked for %s' % cls._alias)
+            print('No transport profile worked')
+            return False
+
+        elapsed, transport = min(results, key=lambda r: r[0])
+        cls._config['hosts'][cls._host_alias]['transport'] = transport
+
+        with open(HOSTS_FILENAME, 'w') as f_obj:
+            f_obj.write(json.dumps(cls._config))
+
+        log.info('Stored transport profile for %s: %s' % (cls._host_alias, transport))
+        print('Stored fastest profile for %s: %s' % (cls._host_alias, transport))
+
+        return True
@@ -0,0 +1,46 @@
+import os
+import fcntl
+import logging
+import contextlib
+
+from config import LOCK_DIR
+
+log = logging.getLogger('stm')
+
+
+@contextlib.contextmanager
+def tunnel_lock(key):
+    # serializes check-and-create of one tunnel across stm processes, the
+    # kernel drops the flock when a holder dies so stale lock files are harmless
+    lock_filename = os.path.join(LOCK_DIR, '%s.lock' % key)
+
+    with open(lock_filename, 'a') as f_obj:
+        try:
+            fcntl.flock(f_obj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.info('Waiting for %s to be created by another process' % key)
+            fcntl.flock(f_obj, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f_obj, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def singleton_lock(key):
+    # held for the lifetime of a long running process, yields False when
+    # another process already holds it instead of waiting
+    lock_filename = os.path.join(LOCK_DIR, '%s.lock' % key)
+
+    with open(lock_filename, 'a') as f_obj:
+        try:
+            fcntl.flock(f_obj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f_obj, fcntl.LOCK_UN)
@@ -0,0 +1,74 @@
+import json
+import time
+import logging
+
+from config import HOSTS_FILENAME, WATCHDOG_INTERVAL, WATCHDOG_MISSES, WATCHDOG_LOAD_FAILURES
+from bastion import WATCHDOG_LOCK, get_bastions, ensure_main_tunnel, is_main_tunnel_alive
+from tunnel_lock import singleton_lock
+from transport import get_transport
+from alias_index import get_live_status
+from log_setup import log_fields
+
+log = logging.getLogger('stm')
+
+
+class Watchdog(object):
+
+    def __init__(self):
+        self._misses = {}
+        self._load_failures = 0
+
+    def run(self):
+        # autossh keeps redialing a dead bastion on its own, the watchdog
+        # moves the main tunnel to the next bastion instead
+        with singleton_lock(WATCHDOG_LOCK) as acquired:
+            if not acquired:
+                log.info('Watchdog is already running')
+                return
+
+            log.info('Watchdog started')
+
+            while self._check():
+                time.sleep(WATCHDOG_INTERVAL)
+
+        log.info('Watchdog stopped')
+
+    def _check(self):
+        try:
+            with open(HOSTS_FILENAME, 'r') as f_obj:
+                config = json.loads(f_obj.read())
+        except Exception as e:
+            self._load_failures += 1
+            log.exception('Watchdog failed to load conf')
+            return self._load_failures < WATCHDOG_LOAD_FAILURES
+
+        self._load_failures = 0
+        forwarded_ports, forwarder_ports = get_live_status()
+        active = False
+
+        for host_alias, conf in config['hosts'].items():
+            parent_port = conf['port']
+            if parent_port not in forwarded_ports:
+                self._misses.pop(parent_port, None)
+                continue
+
+            active = True
+            if is_main_tunnel_alive(parent_port):
+                self._misses.pop(parent_port, None)
+                continue
+
+            # a single miss can be autossh reconnecting, only fail over after
+            # the tunnel stayed silent for several checks
+            self._misses[parent_port] = self._misses.get(parent_port, 0) + 1
+            if self._misses[parent_port] < WATCHDOG_MISSES:
+                continue
+
+            alias = sorted(conf['users'].values())[0]
+            started = time.time()
+            restored = ensure_main_tunnel(
+                alias, conf['host'], parent_port, get_bastions(conf), get_transport(conf))
+            log.info('Watchdog checked main tunnel of %s' % host_alias,
+                     extra=log_fields(alias, 'watchdog', 'failed_over' if restored else 'failed', started))
+            self._misses.pop(parent_port, None)
+
+        return active